@@ -0,0 +1,642 @@
+"""tar archive writer with parallel block compression
+
+Archives can be written at once (`create_archive`) or while downloading (`StreamingArchive`).
+The tar stream is cut into independent blocks, each compressed on its own
+(in a thread pool, `lzma` and `zlib` release the GIL) and written out in order.
+Concatenated xz streams / gzip members are still valid `.tar.xz` / `.tar.gz` files.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import io
+import json
+import lzma
+import os
+import subprocess
+import tarfile
+import threading
+import time
+import typing
+import zlib
+from dataclasses import dataclass
+
+import scheduler
+import tracing
+
+CODEC_EXTENSIONS = {
+    'xz': '.tar.xz',
+    'xz-cli': '.tar.xz',  # external `xz -T`
+    'gz': '.tar.gz',
+    'none': '.tar',
+}
+
+# name of the index member, last member of an indexed archive
+INDEX_MEMBER = 'archive_index.json'
+
+# level for "no compression at all"
+STORE = -1
+
+# already compressed, use store_level for these
+STORE_EXTENSIONS = ('.ts', '.aac', '.m4a', '.mp4', '.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+@dataclass
+class ArchiveOptions:
+    codec: str = 'xz'
+    level: int = 9
+    extreme: bool = True  # xz only
+    threads: int = 0  # 0 = cpu count
+    block_size: int = 8 * 1024 * 1024  # uncompressed bytes per block
+    store_level: typing.Optional[int] = STORE  # None = always use level
+    store_extensions: typing.Sequence[str] = STORE_EXTENSIONS
+    index: bool = True  # write member index for ArchiveReader (xz only)
+
+    def get_threads(self):
+        return self.threads or os.cpu_count() or 1
+
+    def get_extension(self):
+        try:
+            return CODEC_EXTENSIONS[self.codec]
+        except KeyError:
+            raise ValueError(f'Unknown archive codec: {self.codec}') from None
+
+    def level_for(self, filename):
+        if self.store_level is not None and filename.lower().endswith(tuple(self.store_extensions)):
+            return self.store_level
+        return self.level
+
+
+# dictionary size of xz presets 0-9
+_XZ_DICT_SIZE = (256 << 10, 1 << 20, 2 << 20, 4 << 20, 4 << 20, 8 << 20, 8 << 20, 16 << 20, 32 << 20, 64 << 20)
+
+
+def _compress_xz(data, level, extreme, block_size):
+    if level == STORE:
+        return _store_xz(data)
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64,
+                         filters=_xz_filters(level, extreme, block_size))
+
+
+def _xz_filters(level, extreme, block_size):
+    preset = level | (lzma.PRESET_EXTREME if extreme and level > 0 else 0)
+    # dictionary larger than one block is only wasted memory
+    dict_size = max(4096, min(_XZ_DICT_SIZE[level], block_size))
+    return [{'id': lzma.FILTER_LZMA2, 'preset': preset, 'dict_size': dict_size}]
+
+
+def _varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _store_xz(data):
+    """Build a xz stream of LZMA2 uncompressed chunks, valid xz without running the encoder at all."""
+    crc = zlib.crc32
+    flags = b'\x00\x01'  # CRC32 check
+    header = b'\xfd7zXZ\x00' + flags + crc(flags).to_bytes(4, 'little')
+    # block header: size, flags (1 filter), LZMA2 (0x21) with 1 byte property (4KiB dict), padding
+    block_header = b'\x02\x00\x21\x01\x00\x00\x00\x00'
+    block_header += crc(block_header).to_bytes(4, 'little')
+    chunks = []
+    for i in range(0, len(data), 0x10000):
+        chunk = data[i:i + 0x10000]
+        chunks.append(b'\x01' if i == 0 else b'\x02')  # uncompressed chunk (with dict reset)
+        chunks.append((len(chunk) - 1).to_bytes(2, 'big'))
+        chunks.append(chunk)
+    chunks.append(b'\x00')
+    compressed = b''.join(chunks)
+    padding = b'\x00' * (-len(compressed) % 4)
+    check = crc(data).to_bytes(4, 'little')
+    index = b'\x00' + _varint(1) + _varint(len(block_header) + len(compressed) + len(check)) + _varint(len(data))
+    index += b'\x00' * (-len(index) % 4)
+    index += crc(index).to_bytes(4, 'little')
+    footer = (len(index) // 4 - 1).to_bytes(4, 'little') + flags
+    footer = crc(footer).to_bytes(4, 'little') + footer + b'YZ'
+    return b''.join((header, block_header, compressed, padding, check, index, footer))
+
+
+def _compress_gz(data, level, extreme, block_size):
+    if level == STORE:
+        level = 0
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compress_none(data, level, extreme, block_size):
+    return data
+
+
+_COMPRESSORS = {
+    'xz': _compress_xz,
+    'gz': _compress_gz,
+    'none': _compress_none,
+}
+
+
+class ParallelBlockWriter:
+    """Write-only file object, compress blocks of written data in parallel."""
+
+    def __init__(self, fileobj: typing.BinaryIO, options: ArchiveOptions = None):
+        self.fileobj = fileobj
+        self.options = options or ArchiveOptions()
+        try:
+            self._compress = _COMPRESSORS[self.options.codec]
+        except KeyError:
+            raise ValueError(f'Codec {self.options.codec} does not support block compression') from None
+        self.level = self.options.level
+        self._threads = self.options.get_threads()
+        self._pool = concurrent.futures.ThreadPoolExecutor(self._threads, thread_name_prefix='Compress')
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._position = 0  # uncompressed
+        self._compressed_position = 0
+        self._split = True
+        # [uncompressed offset, uncompressed size, compressed offset, compressed size] of written blocks
+        self.blocks: typing.List[typing.List[int]] = []
+        self.closed = False
+
+    def set_level(self, level):
+        # start a new block on level change
+        if level != self.level:
+            self._submit()
+            self.level = level
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        block_size = self.options.block_size
+        while self._split and len(self._buffer) >= block_size:
+            block = bytes(self._buffer[:block_size])
+            del self._buffer[:block_size]
+            self._submit_block(block)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush_block(self):
+        """End current block and wait for all blocks to be written."""
+        self._submit()
+        while self._pending:
+            self._write_result()
+
+    def last_block(self):
+        """Put all data from now on into one single (last) block."""
+        self.flush_block()
+        self._split = False
+
+    def _submit(self):
+        if self._buffer:
+            block = bytes(self._buffer)
+            self._buffer.clear()
+            self._submit_block(block)
+
+    def _submit_block(self, block):
+        self._pending.append((len(block), self._pool.submit(self._compress_block, block, self.level)))
+        # limit memory: keep at most 2 blocks per thread in flight
+        while self._pending and (self._pending[0][1].done() or len(self._pending) > 2 * self._threads):
+            self._write_result()
+
+    def _compress_block(self, block, level):
+        # each block takes a cpu slot, compression of concurrent pipelines shares the cores
+        with scheduler.slot('cpu'):
+            return self._compress(block, level, self.options.extreme, self.options.block_size)
+
+    def _write_result(self):
+        size, future = self._pending.popleft()
+        data = future.result()
+        offset = self.blocks[-1][0] + self.blocks[-1][1] if self.blocks else 0
+        self.blocks.append([offset, size, self._compressed_position, len(data)])
+        self.fileobj.write(data)
+        self._compressed_position += len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush_block()
+        finally:
+            self.closed = True
+            for size, future in self._pending:
+                future.cancel()
+            self._pool.shutdown()
+
+    def abort(self):
+        self.closed = True
+        for size, future in self._pending:
+            future.cancel()
+        self._pool.shutdown()
+
+
+def list_members(dirname, exclude=()):
+    """Return names (relative to dirname) in archive order: sorted, directory contents after directory."""
+    out = []
+    for root, dirs, files in os.walk(dirname):
+        dirs[:] = sorted(d for d in dirs if d not in exclude)
+        for name in dirs + sorted(f for f in files if f not in exclude):
+            out.append(os.path.relpath(os.path.join(root, name), dirname))
+    return out
+
+
+class PipeWriter:
+    """Write-only file object, compress with external `xz`."""
+
+    def __init__(self, fileobj: typing.BinaryIO, options: ArchiveOptions = None):
+        self.options = options or ArchiveOptions(codec='xz-cli')
+        args = ['xz', f'-T{self.options.threads}', f'-{self.options.level}']
+        if self.options.extreme:
+            args.append('-e')
+        # cpu slots are taken while xz is fed and finishing, not while the archive waits for downloads
+        # (holding them there would block block compression of a program which holds the network slot);
+        # at most half of the cpu budget, so remux / tagging of other programs still run
+        self._weight = min(self.options.get_threads(), max(1, scheduler.get_scheduler().get_limit('cpu') // 2))
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=fileobj)
+        self._position = 0
+        self.closed = False
+
+    def set_level(self, level):
+        pass
+
+    def write(self, data):
+        with scheduler.slot('cpu', self._weight):  # a full pipe blocks until xz compressed
+            self._process.stdin.write(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with scheduler.slot('cpu', self._weight):
+            self._process.stdin.close()
+            self._process.wait()
+        assert self._process.returncode == 0
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._process.kill()
+        self._process.wait()
+
+
+def open_block_writer(fileobj: typing.BinaryIO, options: ArchiveOptions = None):
+    options = options or ArchiveOptions()
+    if options.codec == 'xz-cli':
+        return PipeWriter(fileobj, options)
+    return ParallelBlockWriter(fileobj, options)
+
+
+class _TarWriter:
+    """tar of dirname into a block writer, with member index when possible."""
+
+    def __init__(self, dirname, fileobj: typing.BinaryIO, options: ArchiveOptions):
+        self.dirname = dirname
+        self.options = options
+        self.writer = open_block_writer(fileobj, options)
+        self.index = options.index and options.codec == 'xz'
+        self.members: typing.List[typing.List] = []  # name, start, end, size
+        try:
+            self.tar = tarfile.open(fileobj=self.writer, mode='w')
+            self.tar.add(dirname, recursive=False)
+        except BaseException:
+            self.writer.abort()
+            raise
+
+    def add(self, name):
+        path = os.path.join(self.dirname, name)
+        self.writer.set_level(self.options.level_for(name))
+        start = self.writer.tell()
+        self.tar.add(path, recursive=False)
+        if os.path.isfile(path):
+            self.members.append([name, start, self.writer.tell(), self.tar.members[-1].size])
+
+    def close(self):
+        if self.index:
+            # index goes into the last block, with the end of archive
+            self.writer.last_block()
+            self.writer.set_level(self.options.level)
+            index = {
+                'version': 1,
+                'dirname': self.dirname,
+                'blocks': self.writer.blocks,
+                'members': self.members,
+            }
+            data = json.dumps(index, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            info = tarfile.TarInfo(f'{self.dirname}/{INDEX_MEMBER}')
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.tar.addfile(info, io.BytesIO(data))
+        self.tar.close()
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+
+def write_tar(dirname, fileobj: typing.BinaryIO, options: ArchiveOptions = None, exclude=()):
+    options = options or ArchiveOptions()
+    tw = _TarWriter(dirname, fileobj, options)
+    try:
+        for name in list_members(dirname, exclude):
+            tw.add(name)
+        tw.close()
+    except BaseException:
+        tw.abort()
+        raise
+
+
+class StreamingArchive:
+    """Archive of dirname, written while files are still being added to it.
+
+    Files are appended in the fixed order of `members` (names relative to dirname):
+    a file committed early waits until all members before it are committed.
+    Each file is read back from disk when it is appended, usually from the page cache right after
+    its commit (a file waiting for earlier members may have to be read from disk again). Committed
+    data is not kept in memory, since media files can be large and may wait for earlier members.
+
+    mirror (a write-only file object with close and abort, e.g. s3_publish.S3Stream) gets the archive file
+    while it grows; it is closed with the archive, or aborted.
+    """
+
+    def __init__(self, dirname, archive_file, members: typing.Iterable[str], options: ArchiveOptions = None,
+                 mirror=None):
+        self.dirname = dirname
+        self.archive_file = archive_file
+        self.options = options or ArchiveOptions()
+        self.members = list(members)
+        self.mirror = mirror
+        self._next = 0
+        self._ready = set()
+        self._done = set()
+        self._lock = threading.Lock()  # commits may come from several threads
+        self._file = open(archive_file, 'wb')
+        # archive files are written forward only (also by xz-cli), so the mirror follows with its own handle
+        self._mirror_file = open(archive_file, 'rb') if mirror is not None else None
+        try:
+            self._tar = _TarWriter(dirname, self._file, self.options)
+        except BaseException:
+            self._file.close()
+            self._close_mirror(abort=True)
+            os.remove(archive_file)
+            raise
+
+    def commit(self, name):
+        """Mark file `name` as complete, it must not be changed any more."""
+        with self._lock:
+            if name in self._done:
+                return
+            if name not in self.members:
+                self.members.append(name)
+            self._ready.add(name)
+            while self._next < len(self.members) and self.members[self._next] in self._ready:
+                name = self.members[self._next]
+                self._ready.remove(name)
+                self._add(name)
+                self._next += 1
+
+    def _add(self, name):
+        self._tar.add(name)
+        self._done.add(name)
+        self._sync_mirror()
+
+    def _sync_mirror(self):
+        if self._mirror_file is None:
+            return
+        self._file.flush()
+        while True:
+            data = self._mirror_file.read(1024 * 1024)
+            if not data:
+                break
+            self.mirror.write(data)
+
+    def _close_mirror(self, abort=False):
+        if self._mirror_file is None:
+            return
+        self._mirror_file.close()
+        self._mirror_file = None
+        if abort:
+            self.mirror.abort()
+        else:
+            self.mirror.close()
+
+    def get_members(self) -> typing.List[dict]:
+        """Archived files, as dicts of name and size."""
+        return [{'name': name, 'size': size} for name, start, end, size in self._tar.members]
+
+    @tracing.traced('StreamingArchive.close', 'cpu')
+    def close(self):
+        """Add remaining members in order (if exist) and finish the archive. Return archive filename."""
+        with self._lock:
+            return self._close()
+
+    def _close(self):
+        try:
+            for name in self.members[self._next:]:
+                if name in self._done:
+                    continue
+                if os.access(os.path.join(self.dirname, name), os.F_OK):
+                    self._add(name)
+                else:
+                    print(f'warning: "{name}" missing, not archived')
+            self._next = len(self.members)
+            self._tar.close()
+            self._sync_mirror()
+            self._file.close()
+            self._close_mirror()
+        except BaseException:
+            self.abort()
+            raise
+        return self.archive_file
+
+    def abort(self):
+        self._tar.abort()
+        self._file.close()
+        self._close_mirror(abort=True)
+        if os.access(self.archive_file, os.F_OK):
+            os.remove(self.archive_file)
+
+
+@tracing.traced(cat='cpu')
+def create_archive(dirname, archive_file, options: ArchiveOptions = None, exclude=()):
+    options = options or ArchiveOptions()
+    print(f'archiving to {archive_file} ({options.codec}, level {options.level}, '
+          f'{options.get_threads()} threads)')
+    try:
+        with open(archive_file, 'wb') as f:
+            write_tar(dirname, f, options, exclude)
+    except BaseException:
+        if os.access(archive_file, os.F_OK):
+            os.remove(archive_file)
+        raise
+
+
+def _read_varint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+class ArchiveReader:
+    """Random access to an indexed `.tar.xz`, only decompress blocks containing wanted members."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            self.index = self._read_index()
+        except BaseException:
+            self._file.close()
+            raise
+        self.dirname = self.index['dirname']
+        self.blocks = self.index['blocks']
+        self.members = {name: (start, end, size) for name, start, end, size in self.index['members']}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def _read_index(self):
+        # last xz stream contains only the index member (and end of archive)
+        f = self._file
+        f.seek(0, io.SEEK_END)
+        file_size = f.tell()
+        if file_size < 24:
+            raise ValueError(f'"{self.filename}" is not an indexed archive')
+        f.seek(file_size - 12)
+        footer = f.read(12)
+        if footer[10:12] != b'YZ':
+            raise ValueError(f'"{self.filename}" is not an indexed archive')
+        index_size = (int.from_bytes(footer[4:8], 'little') + 1) * 4
+        f.seek(file_size - 12 - index_size)
+        xz_index = f.read(index_size)
+        count, pos = _read_varint(xz_index, 1)
+        blocks_size = 0
+        for _ in range(count):
+            unpadded, pos = _read_varint(xz_index, pos)
+            uncompressed, pos = _read_varint(xz_index, pos)
+            blocks_size += (unpadded + 3) // 4 * 4
+        stream_size = 12 + blocks_size + index_size + 12
+        f.seek(file_size - stream_size)
+        tail = lzma.decompress(f.read(stream_size))
+        with tarfile.open(fileobj=io.BytesIO(tail), mode='r') as tar:
+            info = tar.next()
+            if info is None or os.path.basename(info.name) != INDEX_MEMBER:
+                raise ValueError(f'"{self.filename}" is not an indexed archive')
+            return json.load(tar.extractfile(info))
+
+    def _read_range(self, start, end) -> bytes:
+        out = []
+        first = None
+        for u_offset, u_size, c_offset, c_size in self.blocks:
+            if u_offset + u_size <= start or u_offset >= end:
+                continue
+            if first is None:
+                first = u_offset
+            self._file.seek(c_offset)
+            out.append(lzma.decompress(self._file.read(c_size)))
+        data = b''.join(out)
+        return data[start - first:end - first]
+
+    def list(self) -> typing.List[str]:
+        """Names of files, relative to the project directory."""
+        return list(self.members.keys())
+
+    def getsize(self, name):
+        return self.members[name][2]
+
+    def read(self, name) -> bytes:
+        start, end, size = self.members[name]
+        with tarfile.open(fileobj=io.BytesIO(self._read_range(start, end)), mode='r') as tar:
+            info = tar.next()
+            return tar.extractfile(info).read()
+
+    def extract(self, name, path='.'):
+        """Extract one file to path/dirname/name, return the filename."""
+        filename = os.path.join(path, self.dirname, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(self.read(name))
+        return filename
+
+
+def test_budgets(timeout=60):
+    """Two programs archiving while downloading, external xz and block writer, with 1 network and 1 cpu slot."""
+    import shutil
+    import tempfile
+
+    scheduler.configure({'network': 1, 'cpu': 1})
+    temp_dir = tempfile.mkdtemp()
+    try:
+        archives = []
+        for name, codec in (('a', 'xz-cli'), ('b', 'xz')):
+            dirname = os.path.join(temp_dir, name)
+            os.makedirs(dirname)
+            options = ArchiveOptions(codec=codec, level=1, threads=1, block_size=64 * 1024, store_level=None)
+            members = [f'{i:02d}.bin' for i in range(8)]
+            archives.append((dirname, StreamingArchive(dirname, f'{dirname}.tar.xz', members, options)))
+
+        def download(dirname, archive):
+            with scheduler.slot('network'):
+                for name in archive.members:
+                    with open(os.path.join(dirname, name), 'wb') as f:
+                        f.write(os.urandom(16 * 1024) * 16)
+                    archive.commit(name)
+                    time.sleep(0.01)
+            archive.close()
+
+        # the block writer downloads first: it holds the network slot while its blocks wait for cpu
+        threads = [threading.Thread(target=download, args=x, daemon=True) for x in reversed(archives)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.1)
+        for thread in threads:
+            thread.join(timeout)
+        if any(x.is_alive() for x in threads):
+            print('deadlock')
+            os._exit(1)  # blocked threads would keep the process alive
+        for dirname, archive in archives:
+            with tarfile.open(archive.archive_file) as tar:
+                assert len(tar.getmembers()) == 1 + 8 + (archive.options.codec == 'xz'), tar.getnames()
+        print('ok')
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) == 2 and sys.argv[1] == 'test':
+        test_budgets()
+        sys.exit(0)
+    if len(sys.argv) < 3 or sys.argv[1] not in ('create', 'list', 'extract'):
+        print(f'usage: {sys.argv[0]} create <dir> | list <archive> | extract <archive> <name> [out_dir] | test')
+        sys.exit(-1)
+    if sys.argv[1] == 'create':
+        _dirname = sys.argv[2].rstrip('/\\')
+        create_archive(_dirname, _dirname + '.tar.xz')
+    else:
+        with ArchiveReader(sys.argv[2]) as _reader:
+            if sys.argv[1] == 'list':
+                for _name in _reader.list():
+                    print(f'{_reader.getsize(_name):>12} {_name}')
+            else:
+                print(_reader.extract(sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else '.'))
@@ -0,0 +1,231 @@
+"""content-addressed archive store
+
+Layout of the store directory:
+  blobs/<sha256[:2]>/<sha256>[.xz|.gz]  file contents, written and compressed only once
+  manifests/<project>.json              files of a project, referencing blobs by hash
+
+usage:
+  python archive_store.py list <store_dir>
+  python archive_store.py restore <store_dir> <project> [out_dir]
+"""
+
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import shutil
+import sys
+import threading
+import time
+import typing
+
+from archive import ArchiveOptions, STORE, _xz_filters
+import scheduler
+import tools
+
+_BLOB_SUFFIXES = {
+    'xz': '.xz',
+    'gz': '.gz',
+}
+CHUNK_SIZE = 1024 * 1024
+
+
+class ArchiveStore:
+    def __init__(self, root, options: ArchiveOptions = None):
+        self.root = root
+        self.options = options or ArchiveOptions()
+        if self.options.codec not in ('xz', 'gz', 'none'):
+            raise ValueError(f'Codec {self.options.codec} is not supported by archive store')
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.manifest_dir = os.path.join(root, 'manifests')
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+    def _blob_path(self, digest, suffix=''):
+        return os.path.join(self.blob_dir, digest[:2], digest + suffix)
+
+    def find_blob(self, digest) -> typing.Optional[str]:
+        for suffix in ('', '.xz', '.gz'):
+            path = self._blob_path(digest, suffix)
+            if os.access(path, os.F_OK):
+                return path
+        return None
+
+    def put_file(self, filename) -> typing.Tuple[str, int, bool]:
+        """Store content of filename, return (sha256, size, is_new)."""
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        size = os.path.getsize(filename)
+        if self.find_blob(digest) is not None:
+            return digest, size, False
+
+        level = self.options.level_for(filename)
+        if self.options.codec == 'none' or level == STORE:
+            suffix = ''
+        else:
+            suffix = _BLOB_SUFFIXES[self.options.codec]
+        path = self._blob_path(digest, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique per thread: identical content may be committed by several threads at once
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(filename, 'rb') as fsrc, open(temp_path, 'wb') as fdst:
+                if not suffix:
+                    shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+                else:
+                    with scheduler.slot('cpu'):
+                        self._compress_file(fsrc, fdst, level, size)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.access(temp_path, os.F_OK):
+                os.remove(temp_path)
+            raise
+        return digest, size, True
+
+    def _compress_file(self, fsrc, fdst, level, size):
+        if self.options.codec == 'xz':
+            compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64,
+                                             filters=_xz_filters(level, self.options.extreme, size))
+            for chunk in iter(lambda: fsrc.read(CHUNK_SIZE), b''):
+                fdst.write(compressor.compress(chunk))
+            fdst.write(compressor.flush())
+        else:
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=fdst, mtime=0) as gz:
+                shutil.copyfileobj(fsrc, gz, CHUNK_SIZE)
+
+    def read_blob(self, digest) -> bytes:
+        path = self.find_blob(digest)
+        if path is None:
+            raise FileNotFoundError(f'Blob {digest} not found')
+        with open(path, 'rb') as f:
+            content = f.read()
+        if path.endswith('.xz'):
+            content = lzma.decompress(content)
+        elif path.endswith('.gz'):
+            content = gzip.decompress(content)
+        if hashlib.sha256(content).hexdigest() != digest:
+            raise ValueError(f'Blob {digest} is corrupted')
+        return content
+
+    def open_project(self, dirname, members: typing.Iterable[str]) -> 'StoreArchive':
+        return StoreArchive(self, dirname, members)
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifest_dir, f'{name}.json')
+
+    def list_projects(self):
+        return sorted(x[:-len('.json')] for x in os.listdir(self.manifest_dir) if x.endswith('.json'))
+
+    def load_manifest(self, name) -> dict:
+        with open(self.manifest_path(name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def restore(self, name, out_dir=None):
+        """Rebuild the project directory of manifest `name`, return the directory."""
+        manifest = self.load_manifest(name)
+        out_dir = out_dir or manifest['dirname']
+        print(f'restoring "{name}" to "{out_dir}"')
+        os.makedirs(out_dir, exist_ok=False)
+        for member in manifest['members']:
+            filename = os.path.join(out_dir, member['name'])
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as f:
+                f.write(self.read_blob(member['sha256']))
+            os.chmod(filename, member['mode'])
+            os.utime(filename, (member['mtime'], member['mtime']))
+        return out_dir
+
+
+class StoreArchive:
+    """Same interface as archive.StreamingArchive, but stores into an ArchiveStore."""
+
+    def __init__(self, store: ArchiveStore, dirname, members: typing.Iterable[str]):
+        self.store = store
+        self.dirname = dirname
+        self.members = list(members)
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            store.options.get_threads(), thread_name_prefix='Store')
+        self._futures: typing.Dict[str, concurrent.futures.Future] = {}
+        self._members: typing.List[dict] = []
+        self._lock = threading.Lock()  # commits may come from several threads
+
+    def commit(self, name):
+        """Mark file `name` as complete, it must not be changed any more."""
+        with self._lock:
+            if name in self._futures:
+                return
+            if name not in self.members:
+                self.members.append(name)
+            self._futures[name] = self._pool.submit(self.store.put_file, os.path.join(self.dirname, name))
+
+    def close(self):
+        """Store remaining members (if exist) and write the manifest. Return manifest filename."""
+        try:
+            for name in self.members:
+                if name not in self._futures:
+                    if os.access(os.path.join(self.dirname, name), os.F_OK):
+                        self.commit(name)
+                    else:
+                        print(f'warning: "{name}" missing, not archived')
+            members = []
+            new_count = 0
+            new_size = 0
+            for name in self.members:
+                if name not in self._futures:
+                    continue
+                digest, size, is_new = self._futures[name].result()
+                st = os.stat(os.path.join(self.dirname, name))
+                members.append({
+                    'name': name,
+                    'size': size,
+                    'mode': st.st_mode & 0o777,
+                    'mtime': int(st.st_mtime),
+                    'sha256': digest,
+                })
+                if is_new:
+                    new_count += 1
+                    new_size += size
+        finally:
+            self._pool.shutdown()
+        manifest = {
+            'version': 1,
+            'dirname': os.path.basename(os.path.normpath(self.dirname)),
+            'created': int(time.time()),
+            'members': members,
+        }
+        manifest_file = self.store.manifest_path(manifest['dirname'])
+        temp_filename = f'{manifest_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        # manifests of the same project are kept, as .1.json, .2.json, ...
+        manifest_file = tools.publish_file(temp_filename, manifest_file, ext='.json', unique=True)
+        print(f'stored {len(members)} files, {new_count} new ({new_size} bytes)')
+        self._members = members
+        return manifest_file
+
+    def get_members(self) -> typing.List[dict]:
+        """Stored files (after close), as dicts of name, size and sha256."""
+        return [{'name': x['name'], 'size': x['size'], 'sha256': x['sha256']} for x in self._members]
+
+    def abort(self):
+        # blobs already written are valid, keep them
+        for future in self._futures.values():
+            future.cancel()
+        self._pool.shutdown()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('list', 'restore'):
+        print(__doc__)
+        sys.exit(-1)
+    _store = ArchiveStore(sys.argv[2])
+    if sys.argv[1] == 'list':
+        for _name in _store.list_projects():
+            print(_name)
+    else:
+        _store.restore(sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None)
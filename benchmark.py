@@ -0,0 +1,472 @@
+"""benchmarks
+
+usage:
+  python benchmark.py archive [project_dir]
+    without project_dir, a synthetic project of real size is generated
+  python benchmark.py podcast [episodes]
+    render a synthetic feed (default 10000 episodes) without cache, with cold and warm cache
+  python benchmark.py server [url] [connections] [requests]
+    load test of static_server.py on localhost (started on a temp directory without url):
+    keep-alive connections doing full, range and conditional requests
+  python benchmark.py e2e <cassette_dir> [program] [latency_ms] [bandwidth_kib]
+    full episode run (default pstl) replayed from a cassette (see cassette.py) in a scratch directory,
+    wall time per pipeline stage
+  python benchmark.py micro [results.json] [name filter]
+    micro benchmarks (s3_etag, guess_chunksize, podcast, wikitext, DownloadQueue on localhost),
+    best time per call, written to results.json
+  python benchmark.py compare [--allow-missing] <baseline.json> [results.json] [budgets.json]
+    compare results (run now without results.json) to a baseline, exit code 1 if a benchmark is slower
+    than its budget: budgets.json {"name or fnmatch pattern": allowed ratio}, default ratio 1.25,
+    or if a benchmark of the baseline is missing (unless --allow-missing)
+"""
+
+import dataclasses
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import requests
+
+from archive import ArchiveOptions, create_archive
+from podcast import FragmentCache, Podcast, PodcastEpisode
+
+
+def make_project(dirname, minutes=30, segment_seconds=6, bitrate=192 * 1024, seed=1):
+    """Generate a project of real size: random (incompressible) segments, json, playlists and images."""
+    import random
+    rnd = random.Random(seed)
+    os.makedirs(dirname, exist_ok=False)
+    segment_size = bitrate * segment_seconds // 8
+    download_list = []
+    playlist = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{segment_seconds}',
+                '#EXT-X-KEY:METHOD=AES-128,URI="main_1_key_00000.key"']
+    for i in range(minutes * 60 // segment_seconds):
+        filename = f'main_1_segment_{i:05d}.ts'
+        with open(os.path.join(dirname, filename), 'wb') as f:
+            f.write(rnd.randbytes(segment_size))
+        download_list.append((f'https://example.com/{i:05d}.ts', filename))
+        playlist.append(f'#EXTINF:{segment_seconds}.000,')
+        playlist.append(filename)
+    playlist.append('#EXT-X-ENDLIST')
+    with open(os.path.join(dirname, 'main_1_patched.m3u8'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(playlist) + '\n')
+    with open(os.path.join(dirname, 'main_1_key_00000.key'), 'wb') as f:
+        f.write(rnd.randbytes(16))
+    for i in range(8):
+        with open(os.path.join(dirname, f'image_{i}.jpg'), 'wb') as f:
+            f.write(rnd.randbytes(100 * 1024))
+    project = {
+        'info_json': 'program_info.json',
+        'streams': [{
+            'stream_id': 1,
+            'stream_name': 'main',
+            'prefix': 'main_1_',
+            'patched_file': 'main_1_patched.m3u8',
+            'key_files': ['main_1_key_00000.key'],
+            'download_list': download_list,
+        }],
+    }
+    with open(os.path.join(dirname, 'project.json'), 'w', encoding='utf-8') as f:
+        json.dump(project, f)
+    with open(os.path.join(dirname, 'program_info.json'), 'w', encoding='utf-8') as f:
+        json.dump({'episode': {'name': '第1回', 'description': 'x' * 4096}}, f)
+
+
+def _dir_size(dirname):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(dirname) for name in files)
+
+
+def bench_archive(dirname=None):
+    option_list = [
+        ('tar | xz -9 -e (legacy)', ArchiveOptions(codec='xz-cli', threads=1, store_level=None)),
+        ('tar | xz -T0 -9 -e', ArchiveOptions(codec='xz-cli', threads=0, store_level=None)),
+        ('xz blocks', ArchiveOptions(codec='xz', store_level=None)),
+        ('xz blocks + store', ArchiveOptions(codec='xz')),
+        ('gz blocks + store', ArchiveOptions(codec='gz', level=6)),
+    ]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if dirname is None:
+            dirname = os.path.join(temp_dir, 'project')
+            print('generating project...')
+            make_project(dirname)
+        print(f'project size: {_dir_size(dirname) / 1024 / 1024:.1f}MiB, {os.cpu_count()} cpus')
+        results = {}
+        for name, options in option_list:
+            if options.codec == 'xz-cli' and shutil.which('xz') is None:
+                print(f'{name}: skipped (no xz)')
+                continue
+            archive_file = os.path.join(temp_dir, 'archive' + options.get_extension())
+            t = time.perf_counter()
+            create_archive(dirname, archive_file, options)
+            elapsed = time.perf_counter() - t
+            size = os.path.getsize(archive_file)
+            os.remove(archive_file)
+            print(f'{name}: {elapsed:.2f}s, {size / 1024 / 1024:.1f}MiB')
+            results[name] = {'time': elapsed, 'size': size}
+        return results
+
+
+def make_podcast(episodes=10000):
+    pd = Podcast(title='benchmark', image='https://example.com/image.jpg', link='https://example.com/',
+                 author='benchmark', description='synthetic feed\n' * 10, language='ja', block=True)
+    for i in range(episodes):
+        pd.episodes.append(PodcastEpisode(
+            title=f'episode {i:05d}',
+            url=f'https://example.com/audio-{i:05d}-main.m4a',
+            type='audio/mp4',
+            file_length=40 * 1024 * 1024 + i,
+            description=f'episode {i} <description> & notes\n' * 20,
+            guid=f'benchmark-{i}-main',
+            duration=1800 + i,
+            pub_date=1600000000 + i * 7 * 86400,
+        ))
+    return pd
+
+
+def bench_podcast(episodes=10000):
+    pd = make_podcast(episodes)
+    results = {}
+
+    def measure(name, func):
+        t = time.perf_counter()
+        ret = func()
+        results[name] = time.perf_counter() - t
+        print(f'{name}: {results[name]:.3f}s')
+        return ret
+
+    d = measure('to_dict', pd.to_dict)
+    measure('from_dict', lambda: Podcast.from_dict(d))
+    full = measure('render (no cache)', pd.generate_xml)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_file = os.path.join(temp_dir, 'cache.json')
+
+        def render_cached():
+            cache = FragmentCache(cache_file)
+            f = io.StringIO()
+            pd.generate_xml_file(f, cache=cache)
+            cache.save()
+            return f.getvalue()
+
+        measure('render (cold cache)', render_cached)
+        pd.episodes.append(dataclasses.replace(pd.episodes[-1], guid='benchmark-new'))
+        full = pd.generate_xml()
+        cached = measure('render (warm cache, 1 new episode)', render_cached)
+    assert cached == full, 'cached rendering differs'
+    return results
+
+
+def bench_server(url=None, connections=16, requests_per_connection=200):
+    import asyncio
+    import http.client
+    import random
+    import threading
+    import urllib.parse
+    from concurrent.futures import ThreadPoolExecutor
+    from static_server import Route, StaticServer
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if url is None:
+            with open(os.path.join(temp_dir, 'audio.m4a'), 'wb') as f:
+                f.write(random.Random(1).randbytes(8 * 1024 * 1024))
+            server = StaticServer([Route('/', temp_dir)], port=0)
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            async def serve():
+                async with await server.start():
+                    started.set()
+                    await asyncio.Event().wait()
+
+            threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True).start()
+            started.wait()
+            url = f'http://127.0.0.1:{server.port}/audio.m4a'
+        parts = urllib.parse.urlsplit(url)
+
+        def client(seed):
+            rnd = random.Random(seed)
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+            conn.request('HEAD', parts.path)
+            r = conn.getresponse()
+            r.read()
+            size, etag = int(r.getheader('Content-Length')), r.getheader('ETag')
+            received = 0
+            for _ in range(requests_per_connection):
+                kind = rnd.random()
+                headers = {}
+                if kind < 0.1:
+                    pass  # full file
+                elif kind < 0.3:
+                    headers['If-None-Match'] = etag
+                else:
+                    start = rnd.randrange(size)
+                    headers['Range'] = f'bytes={start}-{start + 256 * 1024 - 1}'
+                conn.request('GET', parts.path, headers=headers)
+                r = conn.getresponse()
+                received += len(r.read())
+                assert r.status in (200, 206, 304), r.status
+            conn.close()
+            return received
+
+        t = time.perf_counter()
+        with ThreadPoolExecutor(connections) as pool:
+            received = sum(pool.map(client, range(connections)))
+        elapsed = time.perf_counter() - t
+    count = connections * requests_per_connection
+    print(f'{count} requests on {connections} connections: {elapsed:.2f}s, '
+          f'{count / elapsed:.0f} req/s, {received / elapsed / 1024 / 1024:.1f}MiB/s')
+    return {'time': elapsed, 'requests': count, 'bytes': received}
+
+
+def bench_e2e(cassette_dir, program_name='pstl', latency_ms=0, bandwidth_kib=0, config_file='config.json'):
+    import cassette
+    from main import Loader
+    import tracing
+    import wxpush
+
+    try:
+        config = cassette.load_config(config_file)
+    except FileNotFoundError:
+        config = {'main_config': {}}
+    program_config = config.get('program_config', {}).get(program_name, {})
+    with cassette.ReplayServer(cassette.Cassette(cassette_dir), 0, latency_ms / 1000, bandwidth_kib * 1024) as server:
+        loader = Loader(config['main_config'])
+        cassette.mount(loader.session, cassette.ReplayAdapter(server.base_url))
+        wxpush.WxPusher_URL = f'{server.base_url}/wxpush'
+        tracer = tracing.start()
+        error = None
+        t = time.perf_counter()
+        try:
+            cassette.run_in_workspace(loader, program_name, program_config)
+        except Exception as e:
+            error = e
+        elapsed = time.perf_counter() - t
+        tracing.stop()
+        wxpush.flush()
+
+    stages = {x['name'][len('stage '):]: x['total'] for x in tracer.summary() if x['name'].startswith('stage ')}
+    print(f'\n{program_name} from "{cassette_dir}" (latency {latency_ms}ms, '
+          f'bandwidth {f"{bandwidth_kib}KiB/s" if bandwidth_kib else "unlimited"}): '
+          f'{elapsed:.2f}s, {server.requests} requests, {len(server.missing)} not recorded')
+    for name, total in stages.items():
+        print(f'  {name:<20} {total:8.2f}s')
+    if error is not None:
+        print(f'run failed: {error!r}')
+    return {'time': elapsed, 'stages': stages, 'requests': server.requests, 'missing': len(server.missing),
+            'error': None if error is None else repr(error)}
+
+
+MICRO_BUDGET = 1.25  # default allowed ratio to the baseline
+
+
+def _best_time(func, repeat=5, min_time=0.1):
+    """Best seconds per call of func, calls are repeated until a round takes min_time."""
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - t
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        t = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - t) / number)
+    return best
+
+
+def _micro_s3_etag():
+    import random
+    from s3_etag import s3_etag
+    cases = {}
+    for mib in (1, 16, 64):
+        data = random.Random(mib).randbytes(mib * 1024 * 1024)
+        cases[f's3_etag/{mib}MiB'] = (lambda d=data: s3_etag(d), len(data))
+    data = random.Random(0).randbytes(16 * 1024 * 1024)
+    cases['s3_etag/16MiB file'] = (lambda: s3_etag(io.BytesIO(data)), len(data))
+    return cases
+
+
+def _micro_guess_chunksize():
+    import contextlib
+    import random
+    from s3_etag import guess_chunksize, s3_etag
+    data = random.Random(2).randbytes(24 * 1024 * 1024)
+    etag = s3_etag(data, 5 * 1024 * 1024)
+
+    def guess():
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert guess_chunksize(data, len(data), etag, 1024 * 1024) == 5 * 1024 * 1024
+    return {'guess_chunksize/24MiB': (guess, len(data))}
+
+
+def _micro_podcast():
+    cases = {}
+    for episodes in (1000, 10000):
+        pd = make_podcast(episodes)
+        d = pd.to_dict()
+        cases[f'podcast/to_dict {episodes}'] = (pd.to_dict, None)
+        cases[f'podcast/from_dict {episodes}'] = (lambda d=d: Podcast.from_dict(d), None)
+        cases[f'podcast/generate_xml_file {episodes}'] = (
+            lambda pd=pd: pd.generate_xml_file(io.StringIO()), None)
+        cache = FragmentCache()
+        pd.generate_xml_file(io.StringIO(), cache=cache)
+        cases[f'podcast/generate_xml_file {episodes} cached'] = (
+            lambda pd=pd, cache=cache: pd.generate_xml_file(io.StringIO(), cache=cache), None)
+    return cases
+
+
+def _micro_wikitext():
+    import handler_generic
+    import handler_pstl
+    cfg = handler_pstl.get_config()
+    names = [x[0] for x in handler_pstl.CHARACTER_NAMES_PP]
+    desc = '\r\n\r\n'.join(f'{name}\r\n' + '\r\n'.join(f'line {i} of {name}' for i in range(6)) for name in names)
+    info = {
+        'episode_updated_at': '2024/01/02 03:04:05',
+        'episode': {'name': '第123回', 'episode_parts': [{'description': desc}]},
+    }
+    return {
+        'wikitext/get_anchor_content': (
+            lambda: handler_generic.get_anchor_content(desc.replace('\r\n', '\n'), '<br>', cfg.CHARACTER_NAMES), None),
+        'wikitext/gen_table': (lambda: handler_generic.gen_table(cfg, info), None),
+    }
+
+
+def _micro_download_queue():
+    import random
+    import cassette
+    from download import DownloaderOptions, DownloadQueue
+    from s3_etag import s3_etag
+
+    temp_dir = tempfile.mkdtemp()
+    store = cassette.Cassette(os.path.join(temp_dir, 'cassette'))
+    rnd = random.Random(3)
+    urls = []
+    for i in range(32):
+        body = rnd.randbytes(512 * 1024)
+        urls.append(f'https://cdn.example/{i:05d}.ts')
+        store.add('GET', urls[-1], 200, {'ETag': s3_etag(body), 'Accept-Ranges': 'bytes'}, body)
+    server = cassette.ReplayServer(store).start()
+    cases = {}
+
+    for queue_size in (1, 4):
+        def run(queue_size=queue_size):
+            out_dir = tempfile.mkdtemp(dir=temp_dir)
+            opt = DownloaderOptions(queue_size=queue_size, hide_progress_bar=True, no_output=True)
+
+            def session_factory():
+                session = requests.Session()
+                cassette.mount(session, cassette.ReplayAdapter(server.base_url))
+                return session
+            tasks = [(url, os.path.join(out_dir, f'{i:05d}.ts'), str(i)) for i, url in enumerate(urls)]
+            dq = DownloadQueue(tasks, opt, session_factory=session_factory)
+            dq.run()
+            assert all(x[0] for x in dq.results), dq.results
+            shutil.rmtree(out_dir)
+        cases[f'download_queue/32x512KiB queue {queue_size}'] = (run, 32 * 512 * 1024)
+
+    def cleanup():
+        server.stop()
+        shutil.rmtree(temp_dir)
+    return cases, cleanup
+
+
+MICRO_SUITES = [_micro_s3_etag, _micro_guess_chunksize, _micro_podcast, _micro_wikitext, _micro_download_queue]
+
+
+def bench_micro(results_file=None, name_filter=''):
+    import platform
+    results = {}
+    print(f'{"benchmark":<44} {"per call":>12} {"throughput":>14}')
+    for suite in MICRO_SUITES:
+        cases = suite()
+        cases, cleanup = cases if isinstance(cases, tuple) else (cases, None)
+        try:
+            for name, (func, size) in cases.items():
+                if name_filter not in name:
+                    continue
+                seconds = _best_time(func)
+                results[name] = {'seconds': seconds}
+                throughput = ''
+                if size:
+                    results[name]['mib_s'] = size / seconds / 1024 / 1024
+                    throughput = f'{results[name]["mib_s"]:9.1f}MiB/s'
+                print(f'{name:<44} {seconds * 1000:10.3f}ms {throughput:>14}')
+        finally:
+            if cleanup:
+                cleanup()
+    if results_file is not None:
+        with open(results_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': {'time': int(time.time()), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+                'results': results,
+            }, f, indent=1)
+        print(f'results written to "{results_file}"')
+    return results
+
+
+def compare_micro(baseline_file, results_file=None, budgets_file=None, allow_missing=False) -> bool:
+    """Compare results to baseline, return False if a benchmark is slower than its budget (or missing)."""
+    import fnmatch
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    if results_file is None:
+        results = bench_micro()
+    else:
+        with open(results_file, 'r', encoding='utf-8') as f:
+            results = json.load(f)['results']
+    budgets = {}
+    if budgets_file is not None:
+        with open(budgets_file, 'r', encoding='utf-8') as f:
+            budgets = json.load(f)
+
+    ok = True
+    print(f'\n{"benchmark":<44} {"baseline":>12} {"now":>12} {"ratio":>7} {"budget":>7}')
+    for name, result in results.items():
+        if name not in baseline:
+            print(f'{name:<44} {"-":>12} {result["seconds"] * 1000:10.3f}ms  (new)')
+            continue
+        budget = budgets.get(name)
+        if budget is None:
+            budget = next((v for k, v in budgets.items() if fnmatch.fnmatchcase(name, k)), MICRO_BUDGET)
+        ratio = result['seconds'] / baseline[name]['seconds']
+        regressed = ratio > budget
+        ok = ok and not regressed
+        print(f'{name:<44} {baseline[name]["seconds"] * 1000:10.3f}ms {result["seconds"] * 1000:10.3f}ms '
+              f'{ratio:7.2f} {budget:7.2f}{"  REGRESSED" if regressed else ""}')
+    for name in sorted(baseline.keys() - results.keys()):
+        print(f'{name:<44} missing')
+        ok = ok and allow_missing
+    print('ok' if ok else 'regressed')
+    return ok
+
+
+if __name__ == '__main__':
+    if len(sys.argv) <= 1:
+        print(__doc__)
+        sys.exit(-1)
+    if sys.argv[1] == 'archive':
+        bench_archive(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif sys.argv[1] == 'podcast':
+        bench_podcast(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    elif sys.argv[1] == 'server':
+        bench_server(sys.argv[2] if len(sys.argv) > 2 else None, *(int(x) for x in sys.argv[3:5]))
+    elif sys.argv[1] == 'e2e' and len(sys.argv) > 2:
+        bench_e2e(sys.argv[2], *sys.argv[3:4], *(int(x) for x in sys.argv[4:6]))
+    elif sys.argv[1] == 'micro':
+        bench_micro(*sys.argv[2:4])
+    elif sys.argv[1] == 'compare' and len(sys.argv) > 2:
+        _args = [x for x in sys.argv[2:] if x != '--allow-missing']
+        sys.exit(0 if compare_micro(*_args[:3], allow_missing='--allow-missing' in sys.argv) else 1)
+    else:
+        print(__doc__)
+        sys.exit(-1)
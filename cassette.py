@@ -0,0 +1,335 @@
+"""record / replay HTTP traffic of a run, for offline benchmarks and regression runs
+
+A cassette directory holds responses by request ("GET <url>"):
+  index.json                   status, headers and body hash of each request
+  bodies/<sha256[:2]>/<sha256>  response bodies (decoded), stored once
+
+RecordAdapter is mounted on a session and stores every response it passes through
+(program json, play_check, playlists, keys, segments, images). ReplayServer serves a cassette
+on localhost with configurable latency and bandwidth, ReplayAdapter sends requests of a session there.
+Sessions created by DownloadQueue get the same adapters (download.mounted_session_factory).
+
+Partial (206) responses are not recorded; on replay, byte ranges are cut from the full body.
+
+usage:
+  python cassette.py record <cassette_dir> <program> [config.json]
+    run the program once (in a scratch directory, nothing is published) and record its traffic
+  python cassette.py serve <cassette_dir> [port] [latency_ms] [bandwidth_kib]
+  python benchmark.py e2e <cassette_dir> [program] [latency_ms] [bandwidth_kib]
+"""
+
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import typing
+import urllib.parse
+
+import requests
+import requests.adapters
+
+from static_server import HTTPError, parse_range
+
+INDEX_FILE = 'index.json'
+# not kept: body is stored decoded and served with its own length
+SKIPPED_HEADERS = {'content-length', 'content-encoding', 'transfer-encoding', 'connection', 'keep-alive'}
+CHUNK_SIZE = 16 * 1024
+
+# main_config / program_config overrides of a recording or replay run, paths are relative to the scratch directory
+WORKSPACE_CONFIG = {
+    'AUDIO_DIR': 'audio',
+    'ARCHIVE_DIR': 'archive',
+    'PODCAST_FILE': '',
+    'PODCAST_CACHE_FILE': '',
+    'PODCAST_MANIFEST_FILE': '',
+    'CATALOG_FILE': 'catalog.db',
+    'IMAGE_CACHE_DIR': None,  # images are requested (recorded) every time
+    'S3': None,  # nothing is published
+}
+
+
+def request_key(method, url):
+    return f'{method.upper()} {url}'
+
+
+class Cassette:
+    def __init__(self, dirname):
+        self.dirname = os.path.abspath(dirname)  # runs change the working directory
+        self.entries: typing.Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        try:
+            with open(os.path.join(dirname, INDEX_FILE), 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)['entries']
+        except FileNotFoundError:
+            pass
+
+    def _body_path(self, digest):
+        return os.path.join(self.dirname, 'bodies', digest[:2], digest)
+
+    def add(self, method, url, status, headers: typing.Mapping[str, str], body: bytes):
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._body_path(digest)
+        if not os.access(path, os.F_OK):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(body)
+            os.replace(temp_path, path)
+        with self._lock:
+            self.entries[request_key(method, url)] = {
+                'status': status,
+                'headers': {k: v for k, v in headers.items() if k.lower() not in SKIPPED_HEADERS},
+                'body': digest,
+                'size': len(body),
+            }
+
+    def get(self, method, url) -> typing.Optional[dict]:
+        return self.entries.get(request_key(method, url))
+
+    def open_body(self, entry) -> typing.BinaryIO:
+        return open(self._body_path(entry['body']), 'rb')
+
+    def save(self):
+        os.makedirs(self.dirname, exist_ok=True)
+        with self._lock:
+            content = json.dumps({'entries': self.entries}, ensure_ascii=False, indent=1)
+        filename = os.path.join(self.dirname, INDEX_FILE)
+        with open(f'{filename}.tmp', 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(f'{filename}.tmp', filename)
+
+    def size(self):
+        return sum(x['size'] for x in self.entries.values())
+
+
+class RecordAdapter(requests.adapters.BaseAdapter):
+    """Send with adapter (default a new HTTPAdapter), record complete responses into cassette."""
+
+    def __init__(self, cassette: Cassette, adapter: requests.adapters.BaseAdapter = None):
+        super().__init__()
+        self.cassette = cassette
+        self.adapter = adapter or requests.adapters.HTTPAdapter()
+
+    def send(self, request, **kwargs):
+        r = self.adapter.send(request, **kwargs)
+        content = r.content  # read all, the response is still readable (iter_content) from memory
+        if r.status_code == 206:
+            print(f'cassette: partial response of {request.url} not recorded')
+        else:
+            self.cassette.add(request.method, request.url, r.status_code, r.headers, content)
+        return r
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(requests.adapters.HTTPAdapter):
+    """Send all requests to a ReplayServer (original url in the path), proxies are ignored."""
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        parts = urllib.parse.urlsplit(request.url)
+        request = request.copy()
+        request.url = f'{self.base_url}/{parts.scheme}/{parts.netloc}{parts.path or "/"}'
+        if parts.query:
+            request.url += f'?{parts.query}'
+        return super().send(request, stream, timeout, verify, cert, None)
+
+
+def mount(session: requests.Session, adapter: requests.adapters.BaseAdapter):
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+class TokenBucket:
+    """Bandwidth shared by all connections, in bytes per second (0 = unlimited)."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, n):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + n / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ReplayServer:
+    """Serve a cassette at http://127.0.0.1:<port>/<scheme>/<host>/<path>, each response is delayed
+    by latency (seconds) and the bodies share bandwidth (bytes per second, 0 = unlimited).
+
+    POST requests to unknown urls (e.g. notifications) are answered with {"code": 1000}.
+    """
+
+    def __init__(self, cassette: Cassette, port=0, latency=0.0, bandwidth=0):
+        self.cassette = cassette
+        self.latency = latency
+        self.bucket = TokenBucket(bandwidth)
+        self.missing: typing.List[str] = []
+        self.requests = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.handle(self, send_body=True)
+
+            def do_HEAD(self):
+                server.handle(self, send_body=False)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                body = json.dumps({'code': 1000, 'msg': 'replay'}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_port
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        self._thread = None
+
+    def original_url(self, path):
+        scheme, _, rest = path.lstrip('/').partition('/')
+        return f'{scheme}://{rest}'
+
+    def handle(self, handler: http.server.BaseHTTPRequestHandler, send_body):
+        self.requests += 1
+        url = self.original_url(handler.path)
+        entry = self.cassette.get('GET', url)
+        if self.latency:
+            time.sleep(self.latency)
+        if entry is None:
+            self.missing.append(url)
+            print(f'cassette: not recorded: {url}')
+            handler.send_error(404)
+            return
+        status, start, end = entry['status'], 0, entry['size']
+        headers = dict(entry['headers'])
+        if status == 200 and 'Range' in handler.headers:
+            try:
+                r = parse_range(handler.headers['Range'], entry['size'])
+            except HTTPError as e:
+                handler.send_response(e.status)
+                handler.send_header('Content-Range', f'bytes */{entry["size"]}')
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            if r is not None:
+                start, end = r
+                status = 206
+                headers['Content-Range'] = f'bytes {start}-{end - 1}/{entry["size"]}'
+        handler.send_response(status)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.send_header('Content-Length', str(end - start))
+        handler.end_headers()
+        if not send_body:
+            return
+        with self.cassette.open_body(entry) as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                self.bucket.consume(len(chunk))
+                handler.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='ReplayServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def load_config(config_file='config.json'):
+    with open(config_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def run_in_workspace(loader, program_name, program_config: dict):
+    """Run program once in a scratch directory (WORKSPACE_CONFIG), return the Loader result."""
+    program_config = {**program_config, **WORKSPACE_CONFIG}
+    cwd = os.getcwd()
+    workspace = tempfile.mkdtemp(prefix=f'{program_name}-')
+    try:
+        os.chdir(workspace)
+        os.makedirs(WORKSPACE_CONFIG['AUDIO_DIR'])
+        os.makedirs(WORKSPACE_CONFIG['ARCHIVE_DIR'])
+        return loader.run(program_name, {}, program_config)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def record(cassette_dir, program_name, config_file='config.json'):
+    from main import Loader
+    import wxpush
+
+    config = load_config(config_file)
+    cassette = Cassette(cassette_dir)
+    loader = Loader(config['main_config'])
+    mount(loader.session, RecordAdapter(cassette))
+    # nothing is published: notifications go to a local server (answers POST like WxPusher)
+    with ReplayServer(cassette) as server:
+        wxpush.WxPusher_URL = f'{server.base_url}/wxpush'
+        try:
+            run_in_workspace(loader, program_name, config.get('program_config', {}).get(program_name, {}))
+        finally:
+            wxpush.flush()
+            cassette.save()
+    print(f'recorded {len(cassette.entries)} responses ({cassette.size() / 1024 / 1024:.1f}MiB) '
+          f'to "{cassette_dir}"')
+
+
+def serve(cassette_dir, port=8081, latency_ms=0, bandwidth_kib=0):
+    server = ReplayServer(Cassette(cassette_dir), port, latency_ms / 1000, bandwidth_kib * 1024)
+    print(f'replaying "{cassette_dir}" at {server.base_url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'record':
+        record(*sys.argv[2:5])
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'serve':
+        serve(sys.argv[2], *(int(x) for x in sys.argv[3:6]))
+    else:
+        print(__doc__)
+        sys.exit(-1)
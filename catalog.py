@@ -0,0 +1,210 @@
+"""SQLite catalog of archived projects and published audio files
+
+usage:
+  python catalog.py <catalog.db> episodes <program>
+  python catalog.py <catalog.db> missing <program> <stream>
+  python catalog.py <catalog.db> members <program> <episode>
+  python catalog.py <catalog.db> import <program> <archive_dir> <audio_dir> <audio_name_prefix>
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import typing
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    program TEXT NOT NULL,
+    episode INTEGER,
+    project TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    sha256 TEXT,
+    created INTEGER
+);
+CREATE INDEX IF NOT EXISTS archives_episode ON archives (program, episode);
+CREATE TABLE IF NOT EXISTS archive_members (
+    archive_id INTEGER NOT NULL REFERENCES archives (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    PRIMARY KEY (archive_id, name)
+);
+CREATE TABLE IF NOT EXISTS audio (
+    program TEXT NOT NULL,
+    episode INTEGER NOT NULL,
+    stream TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    sha256 TEXT,
+    duration INTEGER,
+    video_id INTEGER,
+    created INTEGER,
+    PRIMARY KEY (program, episode, stream)
+);
+'''
+
+
+def file_sha256(filename, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Catalog:
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def add_archive(self, program, episode, project, path, members: typing.Iterable[dict] = ()):
+        """Record an archive file (or store manifest). members: dicts with name, size and optionally sha256."""
+        size = os.path.getsize(path)
+        digest = file_sha256(path)
+        with self.db:
+            self.db.execute('DELETE FROM archives WHERE path = ?', (path,))
+            cur = self.db.execute(
+                'INSERT INTO archives (program, episode, project, path, size, sha256, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (program, episode, project, path, size, digest, int(time.time())))
+            archive_id = cur.lastrowid
+            self.db.executemany(
+                'INSERT OR REPLACE INTO archive_members (archive_id, name, size, sha256) VALUES (?, ?, ?, ?)',
+                [(archive_id, m['name'], m.get('size'), m.get('sha256')) for m in members])
+        return archive_id
+
+    def add_audio(self, program, episode, stream, path, duration=None, video_id=None):
+        size = os.path.getsize(path)
+        digest = file_sha256(path)
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO audio '
+                '(program, episode, stream, path, size, sha256, duration, video_id, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (program, episode, stream, path, size, digest, duration, video_id, int(time.time())))
+
+    def episodes(self, program) -> typing.List[int]:
+        """All known episodes, archived or published."""
+        rows = self.db.execute(
+            'SELECT episode FROM archives WHERE program = ? AND episode IS NOT NULL '
+            'UNION SELECT episode FROM audio WHERE program = ? ORDER BY episode',
+            (program, program))
+        return [x for x, in rows]
+
+    def missing_streams(self, program, stream) -> typing.List[int]:
+        """Known episodes without published audio of stream."""
+        rows = self.db.execute(
+            'SELECT episode FROM ('
+            '  SELECT episode FROM archives WHERE program = ? AND episode IS NOT NULL '
+            '  UNION SELECT episode FROM audio WHERE program = ?'
+            ') WHERE episode NOT IN (SELECT episode FROM audio WHERE program = ? AND stream = ?) '
+            'ORDER BY episode',
+            (program, program, program, stream))
+        return [x for x, in rows]
+
+    def get_audio(self, program, episode) -> typing.List[dict]:
+        cur = self.db.execute(
+            'SELECT stream, path, size, sha256, duration, video_id FROM audio '
+            'WHERE program = ? AND episode = ? ORDER BY stream',
+            (program, episode))
+        return [dict(zip((x[0] for x in cur.description), row)) for row in cur]
+
+    def get_archives(self, program, episode=None) -> typing.List[dict]:
+        if episode is None:
+            cur = self.db.execute(
+                'SELECT id, episode, project, path, size, sha256 FROM archives WHERE program = ? '
+                'ORDER BY episode, id', (program,))
+        else:
+            cur = self.db.execute(
+                'SELECT id, episode, project, path, size, sha256 FROM archives WHERE program = ? AND episode = ? '
+                'ORDER BY id', (program, episode))
+        return [dict(zip((x[0] for x in cur.description), row)) for row in cur]
+
+    def get_members(self, archive_id) -> typing.List[dict]:
+        cur = self.db.execute(
+            'SELECT name, size, sha256 FROM archive_members WHERE archive_id = ? ORDER BY rowid', (archive_id,))
+        return [dict(zip((x[0] for x in cur.description), row)) for row in cur]
+
+    def import_dirs(self, program, archive_dir, audio_dir, audio_name_prefix):
+        """One-time import of existing files (archives need a member index or a store manifest)."""
+        from archive import ArchiveReader
+        from archive_store import ArchiveStore
+
+        for name in sorted(os.listdir(audio_dir)):
+            m = re.match(rf'{re.escape(audio_name_prefix)}-(\d+)-([a-z]+)\.m4a$', name)
+            if m is not None:
+                print(f'audio "{name}"')
+                self.add_audio(program, int(m.group(1)), m.group(2), os.path.join(audio_dir, name))
+
+        for name in sorted(os.listdir(archive_dir)):
+            path = os.path.join(archive_dir, name)
+            if not name.endswith('.tar.xz'):
+                continue
+            try:
+                with ArchiveReader(path) as reader:
+                    info_json = json.loads(reader.read('program_info.json').decode('utf-8'))
+                    members = [{'name': x, 'size': reader.getsize(x)} for x in reader.list()]
+            except (ValueError, KeyError) as e:
+                print(f'skip "{name}": {e}')
+                continue
+            print(f'archive "{name}"')
+            self.add_archive(program, _episode_index(info_json), reader.dirname, path, members)
+
+        if os.path.isdir(os.path.join(archive_dir, 'manifests')):
+            store = ArchiveStore(archive_dir)
+            for project in store.list_projects():
+                manifest = store.load_manifest(project)
+                members = manifest['members']
+                info_member = [x for x in members if x['name'] == 'program_info.json']
+                episode = None
+                if info_member:
+                    info_json = json.loads(store.read_blob(info_member[0]['sha256']).decode('utf-8'))
+                    episode = _episode_index(info_json)
+                print(f'manifest "{project}"')
+                self.add_archive(program, episode, manifest['dirname'], store.manifest_path(project), members)
+
+
+def _episode_index(info_json):
+    m = re.match(r'第(\d+)回', info_json['episode']['name'])
+    return None if m is None else int(m.group(1))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print(__doc__)
+        sys.exit(-1)
+    with Catalog(sys.argv[1]) as _catalog:
+        _command, _program = sys.argv[2], sys.argv[3]
+        if _command == 'episodes':
+            for _episode in _catalog.episodes(_program):
+                _streams = ', '.join(x['stream'] for x in _catalog.get_audio(_program, _episode))
+                print(f'{_episode:4d} {_streams}')
+        elif _command == 'missing':
+            print(' '.join(str(x) for x in _catalog.missing_streams(_program, sys.argv[4])))
+        elif _command == 'members':
+            for _archive in _catalog.get_archives(_program, int(sys.argv[4])):
+                print(_archive['path'])
+                for _member in _catalog.get_members(_archive['id']):
+                    print(f'  {_member["size"]:>12} {_member["name"]}')
+        elif _command == 'import':
+            _catalog.import_dirs(_program, *sys.argv[4:7])
+        else:
+            print(__doc__)
+            sys.exit(-1)
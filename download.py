@@ -10,6 +10,7 @@ import typing
 import json
 
 import requests
+import requests.adapters
 # import requests.structures
 try:
     import tqdm
@@ -17,6 +18,7 @@ except ModuleNotFoundError:
     tqdm = None
 
 from s3_etag import check_etag_header
+import tracing
 
 validator = check_etag_header
 
@@ -230,11 +232,27 @@ class SingleDownloader:
         return done, error, response_headers
 
 
+def mounted_session_factory(session: requests.Session) -> typing.Callable[[], requests.Session]:
+    """Factory of new sessions with the custom adapters of session (e.g. cassette record / replay) mounted."""
+    adapters = {prefix: adapter for prefix, adapter in session.adapters.items()
+                if type(adapter) is not requests.adapters.HTTPAdapter}
+
+    def factory():
+        s = requests.Session()
+        for prefix, adapter in adapters.items():
+            s.mount(prefix, adapter)
+        return s
+    return factory
+
+
 class DownloadQueue:
-    def __init__(self, tasks, options: DownloaderOptions = None):
+    def __init__(self, tasks, options: DownloaderOptions = None, callback=None,
+                 session_factory: typing.Callable[[], requests.Session] = requests.Session):
         self.tasks: typing.List[typing.Tuple[str, str, str]] = tasks
         self.results: typing.List[typing.Tuple[bool, str]] = []
         self.options = options
+        self.callback = callback  # called with (task_index, success, info) in the thread calling run()
+        self.session_factory = session_factory  # one session per download thread
         self.running = False
         self.task_queue = queue.SimpleQueue()  # id url filename info
         self.result_queue = queue.SimpleQueue()  # is_message? id success message
@@ -243,8 +261,8 @@ class DownloadQueue:
             self.options.hide_progress_bar = True
 
     def run(self):
-        self.task_queue.empty()
-        self.result_queue.empty()
+        self.task_queue = queue.SimpleQueue()
+        self.result_queue = queue.SimpleQueue()
         threads = []
         results = []
         try:
@@ -274,6 +292,8 @@ class DownloadQueue:
                         else:
                             results[i] = (success, info)
                             finished += 1
+                            if self.callback:
+                                self.callback(i, success, info)
                 except KeyboardInterrupt:
                     if not self.options.no_output:
                         print('Please wait for running downloads to finish...')
@@ -292,11 +312,16 @@ class DownloadQueue:
                                 results[i] = (success, info)
                                 bar.update(1)
                                 finished += 1
+                                if self.callback:
+                                    self.callback(i, success, info)
                     except KeyboardInterrupt:
                         bar.write('Please wait for running downloads to finish...')
                         raise
         finally:
             self.running = False
+            # wake up idle threads instead of waiting for their get() timeout
+            for thread in threads:
+                self.task_queue.put(None)
             for thread in threads:
                 thread.join()
             self.results = results
@@ -316,19 +341,23 @@ class DownloadQueue:
                     bar.set_postfix_str(status)
                 bar.update(delta)
 
-            session = requests.Session()
+            session = self.session_factory()
             while self.running:
                 try:
-                    i, url, filename, desc = self.task_queue.get(timeout=1)
+                    task = self.task_queue.get(timeout=1)
                 except queue.Empty:
                     continue
+                if task is None:
+                    break
+                i, url, filename, desc = task
                 dl = SingleDownloader(url, filename, self.options, callback, session=session)
                 downloaded = 0
                 status = ''
                 bar.reset()
                 bar.set_description(desc)
                 try:
-                    dl.start()
+                    with tracing.span('segment', 'network', file=desc):
+                        dl.start()
                     success = dl.status() == DownloadStatus.DONE
                     info = dl.status_string
                 except Exception as e:
@@ -345,16 +374,20 @@ class DownloadQueue:
                     self.result_queue.put((True, i, None, f'{desc}: {status}'))
                     # print(f'{desc}: {status}')
 
-        session = requests.Session()
+        session = self.session_factory()
         while self.running:
             try:
-                i, url, filename, desc = self.task_queue.get(timeout=1)
+                task = self.task_queue.get(timeout=1)
             except queue.Empty:
                 continue
+            if task is None:
+                break
+            i, url, filename, desc = task
             dl = SingleDownloader(url, filename, self.options, callback, session=session)
             status = ''
             try:
-                dl.start()
+                with tracing.span('segment', 'network', file=desc):
+                    dl.start()
                 success = dl.status() == DownloadStatus.DONE
                 info = dl.status_string
             except Exception as e:
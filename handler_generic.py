@@ -0,0 +1,590 @@
+"""generic program handler, driven entirely by program_config
+
+Use it for a program with {"handler": "generic", ...} in ["program_config"][program name] of config.json.
+Keys are the (upper or lower case) names of ProgramConfig fields, e.g.
+
+    "abc": {
+        "handler": "generic",
+        "AUDIO_NAME_PREFIX": "abc-radio",
+        "TITLE_FORMAT": {"main": "ABC {episode:04d}", "additional": "ABC {episode:04d} 楽屋裏"},
+        "PODCAST": {"title": "ABC Radio", "link": "https://hibiki-radio.jp/description/abc"}
+    }
+
+Every run gets its own ProgramConfig, nothing is kept in module globals,
+so several programs can run concurrently in one process (see max_programs in README).
+"""
+
+import dataclasses
+import hashlib
+import json
+import os
+import re
+import shutil
+import string
+import typing
+from dataclasses import dataclass, field
+
+import requests
+
+from archive import ArchiveOptions
+from archive_store import ArchiveStore
+from catalog import Catalog
+from pipeline import Checkpoint, Pipeline
+import hibiki
+from image_cache import ImageCache
+import mp4tools
+from podcast import FeedWriter, FragmentCache, Podcast, PodcastEpisode
+from s3_publish import S3Client, S3Config
+import tools
+from wxpush import sendNotification
+
+# stream name -> key of video info in program_info.json["episode"]
+VIDEO_KEYS = {
+    'main': 'video',
+    'additional': 'additional_video',
+}
+
+
+@dataclass
+class ProgramConfig:
+    program_name: str = ''
+
+    AUDIO_DIR: str = 'audio'
+    ARCHIVE_DIR: str = 'archive'
+    PODCAST_FILE: str = ''  # default <program>.rss
+    PODCAST_CACHE_FILE: typing.Optional[str] = ''  # default <program>_podcast_cache.json, None to disable
+    PODCAST_PAGE_SIZE: int = 0
+    PODCAST_COMPRESS: typing.List[str] = field(default_factory=lambda: ['gz'])
+    PODCAST_MANIFEST_FILE: typing.Optional[str] = ''  # default <program>_podcast_manifest.json, None to disable
+    PODCAST_URL_PREFIX: typing.Optional[str] = None
+    AUDIO_URL_PREFIX: str = 'https://some.domain/'
+    ARCHIVE_BACKEND: str = 'tar'
+    ARCHIVE_CODEC: str = 'xz'
+    ARCHIVE_LEVEL: int = 9
+    ARCHIVE_THREADS: int = 0
+    CATALOG_FILE: typing.Optional[str] = 'catalog.db'
+    IMAGE_CACHE_DIR: typing.Optional[str] = 'image_cache'
+    CHECKPOINT_FILE: str = 'pipeline_state.json'
+
+    PROJECT_FOLDER_PREFIX: str = ''  # default program name
+    AUDIO_NAME_PREFIX: str = ''  # default program name
+    METADATA_ALBUM_ARTIST: typing.Optional[str] = None  # None to keep the artists
+    # (text in description, anchor) for wikitext icons and artist names, empty to use artists as they are
+    CHARACTER_NAMES: typing.List[typing.Tuple[str, str]] = field(default_factory=list)
+    ARTIST_NAMES: typing.Dict[str, str] = field(default_factory=dict)  # anchor -> artist name in tags
+    # song tag and podcast episode title of each stream, fields: program_name, episode, date
+    TITLE_FORMAT: typing.Dict[str, str] = field(default_factory=lambda: {
+        'main': '{program_name} {episode:04d}',
+        'additional': '{program_name} {episode:04d} additional',
+    })
+    COMMENT_FORMAT: str = '{date:%Y-%m-%d} 第{episode}回\n\n{comment}'
+    GUID_FORMAT: str = '{program_name}-{episode}-{video_id}-{stream}'
+    # string.Template with index, date, icon, content and url
+    TABLE_TEMPLATE: str = '|-\n|${index}\n|${date}\n|${icon}\n|style=text-align:left|${content}\n|${url}'
+    TABLE_DATE_FORMAT: str = '{month}月{day}日'
+    TABLE_LINKS: typing.Dict[str, str] = field(default_factory=lambda: {
+        'main': 'audio',
+        'additional': 'additional',
+    })
+    PODCAST: typing.Dict[str, typing.Any] = field(default_factory=dict)  # defaults of a new podcast.Podcast
+    # extra renditions of each stream (mp4 container, tagged like the stream), published as alternate enclosures:
+    # {"name": "opus", "args": ["-c:a", "libopus", "-b:a", "32k"], "type": "audio/mp4; codecs=opus",
+    #  "bitrate": 32000, "title": "Opus 32 kbps"}, args are ffmpeg output options
+    RENDITIONS: typing.List[typing.Dict[str, typing.Any]] = field(default_factory=list)
+    REPORT_TITLE: str = ''  # default "<program> scraping report"
+    # also publish audio, archives (uploaded while written) and podcast files to S3, see s3_publish.S3Config
+    S3: typing.Optional[typing.Dict[str, typing.Any]] = None
+
+    @classmethod
+    def from_dict(cls, program_name, d: dict) -> 'ProgramConfig':
+        names = {x.name for x in dataclasses.fields(cls)}
+        self = cls(program_name=program_name)
+        for k, v in d.items():
+            if k.upper() in names:
+                setattr(self, k.upper(), v)
+            elif k != 'handler':
+                print(f'warning: unknown config "{k}" of {program_name}, ignored')
+        self.PODCAST_FILE = self.PODCAST_FILE or f'{program_name}.rss'
+        if self.PODCAST_CACHE_FILE == '':
+            self.PODCAST_CACHE_FILE = f'{program_name}_podcast_cache.json'
+        if self.PODCAST_MANIFEST_FILE == '':
+            self.PODCAST_MANIFEST_FILE = f'{program_name}_podcast_manifest.json'
+        self.PROJECT_FOLDER_PREFIX = self.PROJECT_FOLDER_PREFIX or program_name
+        self.AUDIO_NAME_PREFIX = self.AUDIO_NAME_PREFIX or program_name
+        self.REPORT_TITLE = self.REPORT_TITLE or f'{program_name} scraping report'
+        return self
+
+    def audio_name(self, episode, stream):
+        return f'{self.AUDIO_NAME_PREFIX}-{episode:04d}-{stream}.m4a'
+
+    def rendition_name(self, episode, stream, rendition):
+        return f'{self.AUDIO_NAME_PREFIX}-{episode:04d}-{stream}-{rendition}.m4a'
+
+
+def get_config(program_name, config: dict, defaults: dict = None) -> ProgramConfig:
+    """Config of a program: defaults (e.g. of a program specific handler) overridden by config."""
+    return ProgramConfig.from_dict(program_name, {**(defaults or {}), **config})
+
+
+def publish_once(src, dst):
+    """Publish src as dst, nothing to do if a failed run of the stage already did (src gone, dst exists)."""
+    if not os.access(src, os.F_OK) and os.access(dst, os.F_OK):
+        print(f'"{dst}" already published')
+        return
+    tools.publish_file(src, dst)
+
+
+def get_s3_client(cfg: ProgramConfig) -> typing.Optional[S3Client]:
+    return None if cfg.S3 is None else S3Client(S3Config.from_dict(cfg.S3))
+
+
+def gen_table(cfg: ProgramConfig, j):
+    episode_name: str = j['episode']['name']
+    match = re.match(r'第(\d+)回', episode_name)
+    assert match is not None
+    episode_index = int(match.group(1))
+
+    time: str = j['episode_updated_at']
+    match = re.match(r'(\d{4})/(\d{2})/(\d{2}) (\d{2}):(\d{2}):(\d{2})', time)
+    assert match is not None
+    date_str = cfg.TABLE_DATE_FORMAT.format(year=int(match.group(1)), month=int(match.group(2)),
+                                            day=int(match.group(3)))
+
+    line_split = '<br>'
+
+    desc: str = j['episode']['episode_parts'][0]['description']
+    desc = desc.strip().replace('\r\n', '\n')
+    anchor_list, content_list = get_anchor_content(desc, line_split, cfg.CHARACTER_NAMES)
+    icon = '|'.join(anchor_list)
+    content = '<br><br>'.join(content_list)
+
+    url = ' '.join(f'[{cfg.AUDIO_URL_PREFIX}{cfg.audio_name(episode_index, stream)} {label}]'
+                   for stream, label in cfg.TABLE_LINKS.items())
+
+    return string.Template(cfg.TABLE_TEMPLATE).substitute(dict(
+        index=episode_index,
+        date=date_str,
+        icon=icon,
+        content=content,
+        url=url,
+    ))
+
+
+def get_anchor_content(desc, line_split='<br>', character_names=()):
+    """Split description into paragraphs of each character, return (anchors, paragraphs).
+
+    Without character_names, anchors are the first lines (names) of the paragraphs.
+    """
+    desc_list = desc.split('\n\n')
+    icons = []
+    contents = []
+    for item in desc_list:
+        lines = [x.strip() for x in item.split('\n')]
+        contents.append(line_split.join(lines))
+
+        name = lines[0]
+        if not character_names:
+            icons.append(name)
+            continue
+        for text, anchor in character_names:
+            if text in name:
+                icons.append(anchor)
+                break
+        else:
+            raise ValueError(f'Unknown name: {name}')
+    return icons, contents
+
+
+def update_artists(artists, character_names=(), map_names=None):
+    if not character_names:
+        return list(artists)
+    out = []
+    for ar in artists:
+        for text, anchor in character_names:
+            if text in ar:
+                out.append(map_names[anchor])
+                break
+        else:
+            raise ValueError(f'Unknown name: {ar}')
+    return out
+
+
+def get_default_podcast(cfg: ProgramConfig):
+    podcast = {
+        'title': cfg.program_name,
+        'link': f'https://hibiki-radio.jp/description/{cfg.program_name}',
+        'language': 'ja',
+        'block': True,
+    }
+    podcast.update(cfg.PODCAST)
+    return Podcast.from_dict(podcast)
+
+
+def get_tags(cfg: ProgramConfig, metadata: dict, date, episode, stream) -> dict:
+    tags = dict(metadata)
+    if cfg.METADATA_ALBUM_ARTIST is not None:
+        tags['albumartist'] = cfg.METADATA_ALBUM_ARTIST
+    tags['artist'] = '/'.join(update_artists(metadata['artist'], cfg.CHARACTER_NAMES, cfg.ARTIST_NAMES))
+    tags['comment'] = cfg.COMMENT_FORMAT.format(date=date, episode=episode, comment=metadata['comment'])
+    tags['song'] = cfg.TITLE_FORMAT[stream].format(program_name=cfg.program_name, episode=episode, date=date)
+    return tags
+
+
+def get_podcast_episode(cfg: ProgramConfig, info_json, metadata: dict, date, episode, stream, filename):
+    """Podcast episode of a published stream, with its published renditions as alternates."""
+    video = info_json['episode'][VIDEO_KEYS[stream]]
+    alternates = []
+    for rendition in cfg.RENDITIONS:
+        name = cfg.rendition_name(episode, stream, rendition['name'])
+        path = os.path.join(cfg.AUDIO_DIR, name)
+        if os.access(path, os.F_OK):
+            alternates.append({
+                'url': f'{cfg.AUDIO_URL_PREFIX}{name}',
+                'type': rendition.get('type', 'audio/mp4'),
+                'length': os.path.getsize(path),
+                'bitrate': rendition.get('bitrate'),
+                'title': rendition.get('title'),
+            })
+    return PodcastEpisode(
+        title=cfg.TITLE_FORMAT[stream].format(program_name=cfg.program_name, episode=episode, date=date),
+        url=f'{cfg.AUDIO_URL_PREFIX}{cfg.audio_name(episode, stream)}',
+        type='audio/mp4',
+        file_length=os.path.getsize(filename),
+        description=metadata['comment'],
+        guid=cfg.GUID_FORMAT.format(program_name=cfg.program_name, episode=episode,
+                                    video_id=video['id'], stream=stream),
+        duration=int(video['duration']),
+        pub_date=int(date.timestamp()),
+        alternates=alternates,
+    )
+
+
+def run(data, defaults: dict = None):
+    program_name: str = data['program_name']
+    info_raw: bytes = data['info_raw']
+    info_json: dict = data['info_json']
+    session: requests.Session = data['session']
+    save: dict = data['save']
+    cfg = get_config(program_name, data['config'], defaults)
+    # print(info_json)
+
+    out = []
+
+    dl = hibiki.Downloader()
+    dl.set_session(session)
+
+    # check if is new
+    date, episode = dl.get_date_episode(info_raw)
+    if episode == save.get('last_episode'):
+        # same episode, but different id, date, etc.
+        skip_audio = True
+        out.append('Warning: same episode number, different identity. Generate audio file skipped')
+    else:
+        skip_audio = False
+
+    project_name = f'{cfg.PROJECT_FOLDER_PREFIX}-{date.year:04d}{date.month:02d}{date.day:02d}'
+    archive_options = ArchiveOptions(codec=cfg.ARCHIVE_CODEC, level=cfg.ARCHIVE_LEVEL, threads=cfg.ARCHIVE_THREADS)
+    if cfg.ARCHIVE_BACKEND == 'store':
+        store = ArchiveStore(cfg.ARCHIVE_DIR, archive_options)
+    else:
+        store = None
+    metadata = dl.get_metadata(info_raw)
+    s3 = get_s3_client(cfg)
+
+    reserved_archive = {}  # name in ARCHIVE_DIR taken for the archive uploaded while written
+
+    pipe = Pipeline(project_name)
+    # resume failed run of the same input
+    checkpoint = Checkpoint(os.path.join(project_name, cfg.CHECKPOINT_FILE), hashlib.sha256(info_raw).hexdigest())
+
+    @pipe.stage()
+    def create_project(inputs):
+        if os.access(project_name, os.F_OK):
+            print(f'project "{project_name}" exists, rename old project')
+            tools.rename_file(project_name, ext='')
+        dl.create_project(info_raw, project_name)
+        with open(os.path.join(project_name, 'project.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    # same media as last archived project (only metadata changed)?
+    @pipe.stage(deps=['create_project'])
+    def media_fingerprint(inputs):
+        fingerprint = dl.get_media_fingerprint(project_name)
+        unchanged = (skip_audio and save.get('last_archive') is not None and
+                     fingerprint == save.get('last_media_fingerprint'))
+        if unchanged:
+            print(f'media unchanged since "{save["last_archive"]}", archive metadata only')
+            with open(os.path.join(project_name, 'delta.json'), 'w', encoding='utf-8') as f:
+                json.dump({
+                    'base_archive': save['last_archive'],
+                    'media_fingerprint': fingerprint,
+                }, f, ensure_ascii=False, indent=1)
+        return {'fingerprint': fingerprint, 'unchanged': unchanged}
+
+    # download all, archive while downloading
+    @pipe.stage(deps=['create_project', 'media_fingerprint'], checkpoint=False)
+    def open_archive(inputs):
+        metadata_only = inputs['media_fingerprint']['unchanged']
+
+        def open_mirror(archive_file):
+            # the S3 key and the local archive (see archive) get the same name
+            name = tools.reserve_filename(os.path.join(cfg.ARCHIVE_DIR, os.path.basename(archive_file)),
+                                          ext=archive_options.get_extension())
+            reserved_archive['file'] = name
+            key = s3.config.archive_prefix + os.path.basename(name)
+            print(f'uploading archive to S3 "{key}" while archiving')
+            return s3.open_stream(key)
+
+        archive = dl.open_archive(project_name, archive_options, store, metadata_only,
+                                  open_mirror if s3 is not None else None)
+        if metadata_only:
+            archive.commit('delta.json')
+        return archive
+
+    @pipe.stage(deps=['open_archive', 'media_fingerprint'])
+    def download(inputs):
+        if inputs['media_fingerprint']['unchanged']:
+            print('media unchanged, download skipped')
+            return
+        dl.download(project_name, inputs['open_archive'])
+
+    @pipe.stage(deps=['open_archive', 'media_fingerprint'])
+    def download_images(inputs):
+        if inputs['media_fingerprint']['unchanged']:
+            print('media unchanged, download images skipped')
+            return
+        cache = None if cfg.IMAGE_CACHE_DIR is None else ImageCache(cfg.IMAGE_CACHE_DIR, session)
+        dl.download_images(project_name, inputs['open_archive'], cache)
+
+    @pipe.stage(deps=['open_archive', 'download', 'download_images'],
+                fingerprint=f'{cfg.ARCHIVE_BACKEND} {archive_options}')
+    def archive(inputs):
+        archive_name = inputs['open_archive'].close()
+        if store is None:
+            if 'file' in reserved_archive:
+                # name of the S3 upload
+                archive_name_dist = tools.publish_file(archive_name, reserved_archive['file'])
+                del reserved_archive['file']
+            else:
+                archive_name_dist = tools.publish_file(
+                    archive_name, os.path.join(cfg.ARCHIVE_DIR, os.path.basename(archive_name)),
+                    ext=archive_options.get_extension(), unique=True)
+            print(f'moved archive to "{archive_name_dist}"')
+        else:
+            archive_name_dist = archive_name
+            print(f'archived to store, manifest "{archive_name}"')
+        return {'file': archive_name_dist, 'members': inputs['open_archive'].get_members()}
+
+    if cfg.CATALOG_FILE is not None:
+        @pipe.stage(deps=['archive'])
+        def catalog_archive(inputs):
+            with Catalog(cfg.CATALOG_FILE) as catalog:
+                catalog.add_archive(program_name, episode, project_name, inputs['archive']['file'],
+                                    inputs['archive']['members'])
+
+    if not skip_audio:
+        # generate audio files
+        @pipe.stage(deps=['create_project', 'download'])
+        def remux(inputs):
+            print(f'remux audio')
+            results = {k: v for k, v in dl.remux(project_name).items() if k in VIDEO_KEYS}
+            errors = {k: v.error for k, v in results.items() if v.error}
+            if errors:
+                # fail the run (resumed next time), instead of publishing the episode without a stream
+                raise RuntimeError(f'remux failed: {errors}')
+
+            # {stream name: filename after remux} of available streams
+            audio = {k: v.filename for k, v in results.items()}
+            print(f'audio: {audio}')
+            return audio
+
+        arts = [
+            os.path.join(project_name,
+                         dl.filename_from_url(info_json['episode']['chapters'][0]['pc_image_url'])),
+            os.path.join(project_name,
+                         dl.filename_from_url(info_json['episode']['episode_parts'][0]['pc_image_url'])),
+        ]
+
+        def write_tags(filename, stream):
+            tags = get_tags(cfg, metadata, date, episode, stream)
+            print(f'{stream} metadata: {tags}')
+            mp4tools.write_tags(filename, tags, wipe=True)
+            mp4tools.write_arts(filename, arts, wipe=True)
+            mp4tools.optimize(filename)
+
+        # tagging (need mp4v2 binary in PATH https://github.com/TechSmith/mp4v2)
+        @pipe.stage(deps=['remux', 'download_images'])
+        def tag(inputs):
+            print(f'tagging')
+            # streams in parallel, each mp4tools call takes a cpu slot
+            tools.parallel_map(lambda stream: write_tags(inputs['remux'][stream], stream), inputs['remux'])
+            return inputs['remux']
+
+        publish_deps = ['tag']
+        if cfg.RENDITIONS:
+            # transcode tagged audio into RENDITIONS, in parallel
+            @pipe.stage(deps=['tag'])
+            def renditions(inputs):
+                keys = []
+                jobs = []
+                for stream, filename in inputs['tag'].items():
+                    for rendition in cfg.RENDITIONS:
+                        keys.append((stream, rendition['name']))
+                        jobs.append((filename, os.path.join(project_name, f'{stream}_{rendition["name"]}.m4a'),
+                                     rendition['args']))
+                out = {}  # {stream: {rendition name: filename}}
+                for (stream, name), (src, dst, args), success in zip(keys, jobs, dl.transcode(jobs)):
+                    if success:
+                        out.setdefault(stream, {})[name] = dst
+                tools.parallel_map(lambda key: write_tags(out[key[0]][key[1]], key[0]),
+                                   [(stream, name) for stream, files in out.items() for name in files])
+                return out
+
+            publish_deps.append('renditions')
+
+        # copy audio files to deploy path
+        @pipe.stage(deps=publish_deps)
+        def publish_audio(inputs):
+            audio_dist = {}
+            for stream, filename in inputs['tag'].items():
+                audio_dist[stream] = os.path.join(cfg.AUDIO_DIR, cfg.audio_name(episode, stream))
+                print(f'copy {stream} to {audio_dist[stream]}')
+                publish_once(filename, audio_dist[stream])
+            for stream, files in inputs.get('renditions', {}).items():
+                for name, filename in files.items():
+                    dist = os.path.join(cfg.AUDIO_DIR, cfg.rendition_name(episode, stream, name))
+                    print(f'copy {stream} {name} to {dist}')
+                    publish_once(filename, dist)
+            return audio_dist
+
+        podcast_deps = ['publish_audio']
+        if s3 is not None or cfg.CATALOG_FILE is not None:
+            # upload and catalog published audio (may fail and run again, files are published already)
+            @pipe.stage(deps=publish_deps + ['publish_audio'])
+            def register_audio(inputs):
+                audio_dist = inputs['publish_audio']
+                if s3 is not None:
+                    published = list(audio_dist.values())
+                    for stream, files in inputs.get('renditions', {}).items():
+                        published += [os.path.join(cfg.AUDIO_DIR, cfg.rendition_name(episode, stream, name))
+                                      for name in files]
+                    tools.parallel_map(lambda x: s3.upload_file(x, s3.config.audio_prefix + os.path.basename(x)),
+                                       published)
+                if cfg.CATALOG_FILE is not None:
+                    with Catalog(cfg.CATALOG_FILE) as catalog:
+                        for stream, filename in audio_dist.items():
+                            video = info_json['episode'][VIDEO_KEYS[stream]]
+                            catalog.add_audio(program_name, episode, stream, filename,
+                                              int(video['duration']), video['id'])
+
+            podcast_deps.append('register_audio')
+
+        # update podcast file (after uploads, the feed links to the audio)
+        @pipe.stage(deps=podcast_deps)
+        def podcast(inputs):
+            print(f'update podcast file')
+            podcast_dict = save.get('podcast', None)
+            if podcast_dict is None:
+                print('warning: generating new podcast file')
+                pd = get_default_podcast(cfg)
+            else:
+                pd = Podcast.from_dict(podcast_dict)
+            pd.description = info_json['description'].strip().replace('\r\n', '\n')
+            for stream in VIDEO_KEYS:
+                if stream in inputs['publish_audio']:
+                    pd.episodes.append(get_podcast_episode(cfg, info_json, metadata, date, episode, stream,
+                                                           inputs['publish_audio'][stream]))
+            write_podcast(cfg, pd, save)
+            return pd.to_dict()
+
+        # generate wikitext
+        @pipe.stage()
+        def wikitext(inputs):
+            print(f'generate wikitext')
+            return gen_table(cfg, info_json)
+
+    try:
+        results = pipe.run(checkpoint)
+    except BaseException:
+        if 'open_archive' in pipe.results and 'archive' not in pipe.results:
+            pipe.results['open_archive'].abort()
+        if 'file' in reserved_archive and os.path.getsize(reserved_archive['file']) == 0:
+            os.remove(reserved_archive['file'])
+        raise
+
+    save['last_media_fingerprint'] = results['media_fingerprint']['fingerprint']
+    if not results['media_fingerprint']['unchanged']:
+        save['last_archive'] = results['archive']['file']
+    if not skip_audio:
+        out.append(f'wikitext:\n{results["wikitext"]}')
+
+        # finally update save data
+        save['last_episode'] = episode
+        save['podcast'] = results['podcast']
+
+    # remove project (be careful when testing)
+    print(f'remove project "{project_name}"')
+    shutil.rmtree(project_name)
+
+    # need wxpush dev account for WeChat notification https://wxpusher.zjiecode.com/
+    if out:
+        out.insert(0, cfg.REPORT_TITLE)
+        out_str = ('\n' + '=' * 20 + '\n').join(out)
+        # out_str = out_str.replace('<', '&lt;')
+        print(f'Send report:\n{out_str}')
+        sendNotification(out_str, summary=cfg.REPORT_TITLE)
+
+    print(f'All done!!!')
+
+
+def write_podcast(cfg: ProgramConfig, pd: Podcast, save: dict):
+    cache = FragmentCache(cfg.PODCAST_CACHE_FILE) if cfg.PODCAST_CACHE_FILE else None
+    writer = FeedWriter(cfg.PODCAST_COMPRESS, cfg.PODCAST_MANIFEST_FILE)
+    if cfg.PODCAST_PAGE_SIZE:
+        written = pd.write_pages(cfg.PODCAST_FILE, cfg.PODCAST_PAGE_SIZE,
+                                 cfg.PODCAST_URL_PREFIX or cfg.AUDIO_URL_PREFIX,
+                                 save.setdefault('podcast_pages', {}), cache=cache, writer=writer)
+    else:
+        written = [cfg.PODCAST_FILE] if writer.write(cfg.PODCAST_FILE, pd.generate_xml(cache=cache)) else []
+    writer.close()
+    print(f'podcast files written: {", ".join(written) or "(unchanged)"}')
+    if cache is not None:
+        print(f'rendered {cache.rendered} of {len(pd.episodes)} podcast episodes')
+        cache.save()
+    s3 = get_s3_client(cfg)
+    if s3 is not None:
+        # all feed files, unchanged objects are skipped (ETag)
+        names = {os.path.basename(cfg.PODCAST_FILE)}
+        if cfg.PODCAST_PAGE_SIZE:
+            names.update(save.get('podcast_pages', {}))  # archive pages
+        for name in sorted(names):
+            path = os.path.join(os.path.dirname(cfg.PODCAST_FILE), name)
+            for filename in [path] + [f'{path}.{ext}' for ext in writer.compress]:
+                s3.upload_file(filename, s3.config.feed_prefix + os.path.basename(filename))
+
+
+def update_podcast(program_name, defaults: dict = None):
+    """Rewrite podcast file of program from save.json."""
+    print(f'update podcast file')
+
+    with open('config.json', 'r', encoding='utf-8') as f:
+        cfg = get_config(program_name, json.load(f).get('program_config', {}).get(program_name, {}), defaults)
+
+    with open('save.json', 'r', encoding='utf-8') as f:
+        save = json.load(f)[program_name]['callback_save']
+
+    podcast_dict = save.get('podcast', None)
+    if podcast_dict is None:
+        raise ValueError('no podcast data')
+    else:
+        pd = Podcast.from_dict(podcast_dict)
+    write_podcast(cfg, pd, save)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) <= 1:
+        print(f'usage: {sys.argv[0]} <program name>  (rewrite podcast file from save.json)')
+        sys.exit(-1)
+    update_podcast(sys.argv[1])
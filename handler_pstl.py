@@ -1,21 +1,29 @@
-import json
-import os
-import shutil
-import string
-import re
+"""Pastel＊Palettesのしゅわりんラジオ (pstl)
+
+Settings of the program for handler_generic, constants are overridden by ["program_config"]["pstl"] of config.json.
+"""
 
-import requests
+import string
 
-import hibiki
-import mp4tools
-from podcast import Podcast, PodcastEpisode
-import tools
-from wxpush import sendNotification
+import handler_generic
+from handler_generic import ProgramConfig
 
 AUDIO_DIR = 'audio'
 ARCHIVE_DIR = 'archive'
 PODCAST_FILE = 'podcast.rss'
+PODCAST_CACHE_FILE = 'podcast_cache.json'  # rendered episodes, None to disable
+PODCAST_PAGE_SIZE = 0  # episodes per archive page of paged feed, 0 for a single feed file
+PODCAST_COMPRESS = ['gz']  # precompressed sidecars of feed files, 'gz' and 'br' (needs brotli)
+PODCAST_MANIFEST_FILE = 'podcast_manifest.json'  # size, sha256 and ETag of feed files, None to disable
+PODCAST_URL_PREFIX = None  # Web URL for directory of PODCAST_FILE (for paged feed), default AUDIO_URL_PREFIX
 AUDIO_URL_PREFIX = 'https://some.domain/shuwarin-radio/'
+ARCHIVE_BACKEND = 'tar'  # 'tar' for one archive file per episode, 'store' for de-duplicating store in ARCHIVE_DIR
+ARCHIVE_CODEC = 'xz'  # 'xz', 'gz', 'none', or 'xz-cli' for external tar & xz
+ARCHIVE_LEVEL = 9
+ARCHIVE_THREADS = 0  # 0 = cpu count
+CATALOG_FILE = 'catalog.db'  # None to disable
+IMAGE_CACHE_DIR = 'image_cache'  # None to disable
+CHECKPOINT_FILE = 'pipeline_state.json'  # in project folder, not archived
 
 PROJECT_FOLDER_PREFIX = 'pstl'
 AUDIO_NAME_PREFIX = 'shuwarin-radio'
@@ -51,260 +59,80 @@ TABLE_TEMPLATE = string.Template('''\
 |${url}''')
 
 
-def gen_table(j):
-    episode_name: str = j['episode']['name']
-    match = re.match(r'第(\d+)回', episode_name)
-    assert match is not None
-    episode_index = int(match.group(1))
-
-    time: str = j['episode_updated_at']
-    match = re.match(r'(\d{4})/(\d{2})/(\d{2}) (\d{2}):(\d{2}):(\d{2})', time)
-    assert match is not None
-    date_str = f'{int(match.group(2))}月{int(match.group(3))}日'
+DEFAULTS = {
+    'AUDIO_DIR': AUDIO_DIR,
+    'ARCHIVE_DIR': ARCHIVE_DIR,
+    'PODCAST_FILE': PODCAST_FILE,
+    'PODCAST_CACHE_FILE': PODCAST_CACHE_FILE,
+    'PODCAST_PAGE_SIZE': PODCAST_PAGE_SIZE,
+    'PODCAST_COMPRESS': PODCAST_COMPRESS,
+    'PODCAST_MANIFEST_FILE': PODCAST_MANIFEST_FILE,
+    'PODCAST_URL_PREFIX': PODCAST_URL_PREFIX,
+    'AUDIO_URL_PREFIX': AUDIO_URL_PREFIX,
+    'ARCHIVE_BACKEND': ARCHIVE_BACKEND,
+    'ARCHIVE_CODEC': ARCHIVE_CODEC,
+    'ARCHIVE_LEVEL': ARCHIVE_LEVEL,
+    'ARCHIVE_THREADS': ARCHIVE_THREADS,
+    'CATALOG_FILE': CATALOG_FILE,
+    'IMAGE_CACHE_DIR': IMAGE_CACHE_DIR,
+    'CHECKPOINT_FILE': CHECKPOINT_FILE,
+    'PROJECT_FOLDER_PREFIX': PROJECT_FOLDER_PREFIX,
+    'AUDIO_NAME_PREFIX': AUDIO_NAME_PREFIX,
+    'METADATA_ALBUM_ARTIST': METADATA_ALBUM_ARTIST,
+    'CHARACTER_NAMES': CHARACTER_NAMES_PP,
+    'ARTIST_NAMES': MAP_PP,
+    'TITLE_FORMAT': {
+        'main': 'しゅわラジ {episode:04d}',
+        'additional': 'しゅわラジ {episode:04d} 楽屋裏',
+    },
+    'COMMENT_FORMAT': '{date:%Y-%m-%d} 第{episode}回\n\n{comment}',
+    'GUID_FORMAT': 'pstl-{episode}-{video_id}-{stream}',
+    'TABLE_TEMPLATE': TABLE_TEMPLATE.template,
+    'TABLE_DATE_FORMAT': '{month}月{day}日',
+    'TABLE_LINKS': {
+        'main': '音频',
+        'additional': '乐屋里音频',
+    },
+    'PODCAST': {
+        'title': 'Pastel＊Palettesのしゅわりんラジオ',
+        'image': '',  # TODO
+        'link': 'https://hibiki-radio.jp/description/pstl',
+        'author': 'Pastel＊Palettes',
+        'description': '',  # auto update
+        'language': 'ja',
+        'block': True,
+        'new_feed_url': None,
+    },
+    'REPORT_TITLE': 'Shuwarin Radio scraping report',
+}
 
-    line_split = '<br>'
 
-    desc: str = j['episode']['episode_parts'][0]['description']
-    desc = desc.strip().replace('\r\n', '\n')
-    anchor_list, content_list = get_anchor_content(desc, line_split)
-    icon = '|'.join(anchor_list)
-    content = '<br><br>'.join(content_list)
+def get_config(config: dict = None) -> ProgramConfig:
+    return handler_generic.get_config('pstl', config or {}, DEFAULTS)
 
-    url = (f'[{AUDIO_URL_PREFIX}{AUDIO_NAME_PREFIX}-{episode_index:04d}-main.m4a 音频] '
-           f'[{AUDIO_URL_PREFIX}{AUDIO_NAME_PREFIX}-{episode_index:04d}-additional.m4a 乐屋里音频]')
 
-    return TABLE_TEMPLATE.substitute(dict(
-        index=episode_index,
-        date=date_str,
-        icon=icon,
-        content=content,
-        url=url,
-    ))
+def gen_table(j, cfg: ProgramConfig = None):
+    return handler_generic.gen_table(cfg or get_config(), j)
 
 
 def get_anchor_content(desc, line_split='<br>', character_names=CHARACTER_NAMES_PP):
-    desc_list = desc.split('\n\n')
-    icons = []
-    contents = []
-    for item in desc_list:
-        lines = [x.strip() for x in item.split('\n')]
-        contents.append(line_split.join(lines))
-
-        name = lines[0]
-        for text, anchor in character_names:
-            if text in name:
-                icons.append(anchor)
-                break
-        else:
-            raise ValueError(f'Unknown name: {name}')
-    return icons, contents
+    return handler_generic.get_anchor_content(desc, line_split, character_names)
 
 
 def update_artists(artists, character_names=CHARACTER_NAMES_PP, map_names=MAP_PP):
-    out = []
-    for ar in artists:
-        for text, anchor in character_names:
-            if text in ar:
-                out.append(map_names[anchor])
-                break
-        else:
-            raise ValueError(f'Unknown name: {ar}')
-    return out
+    return handler_generic.update_artists(artists, character_names, map_names)
 
 
 def get_default_podcast():
-    pd = Podcast(
-        title='Pastel＊Palettesのしゅわりんラジオ',
-        image='',  # TODO
-        link='https://hibiki-radio.jp/description/pstl',
-        author='Pastel＊Palettes',
-        description='',  # auto update
-        language='ja',
-        block=True,
-        new_feed_url=None,
-    )
-    return pd
+    return handler_generic.get_default_podcast(get_config())
 
 
 def run(data):
-    info_raw: bytes = data['info_raw']
-    info_json: dict = data['info_json']
-    session: requests.Session = data['session']
-    save: dict = data['save']
-    config: dict = data['config']
-    globals().update(config)
-    # print(info_json)
-
-    out = []
-
-    dl = hibiki.Downloader()
-    dl.set_session(session)
-
-    # check if is new
-    date, episode = dl.get_date_episode(info_raw)
-    if episode == save.get('last_episode'):
-        # same episode, but different id, date, etc.
-        skip_audio = True
-        out.append('Warning: same episode number, different identity. Generate audio file skipped')
-    else:
-        skip_audio = False
-
-    # create project
-    project_name = f'{PROJECT_FOLDER_PREFIX}-{date.year:04d}{date.month:02d}{date.day:02d}'
-    if os.access(project_name, os.F_OK):
-        print(f'project "{project_name}" exists, rename old project')
-        tools.rename_file(project_name, ext='')
-    dl.create_project(info_raw, project_name)
-    with open(os.path.join(project_name, 'project.json'), 'r', encoding='utf-8') as f:
-        project = json.load(f)
-
-    # download all
-    dl.download(project_name)
-    dl.download_images(project_name)
-
-    # archive (.tar.xz, Linux only)
-    dl.archive(project_name)
-    tar_xz_name = f'{project_name}.tar.xz'
-    tar_xz_name_dist = tools.find_valid_filename(
-        os.path.join(ARCHIVE_DIR, tar_xz_name), ext='.tar.xz')
-    print(f'moving archive to "{tar_xz_name_dist}"')
-    os.rename(tar_xz_name, tar_xz_name_dist)
-
-    if not skip_audio:
-        # generate audio files
-        print(f'remux audio')
-        dl.remux(project_name)
-
-        # test main & addition availability
-        main = None  # <- filename after remux, or None
-        additional = None
-        for stream in project['streams']:
-            prefix = stream['prefix']
-            audio_file = os.path.join(project_name, f'{prefix}out.m4a')
-            if stream['stream_name'] == 'main':
-                main = audio_file
-            elif stream['stream_name'] == 'additional':
-                additional = audio_file
-        print(f'main audio?: {main}')
-        print(f'additional audio?: {additional}')
-
-        # tagging (need mp4v2 binary in PATH https://github.com/TechSmith/mp4v2)
-        print(f'tagging')
-        metadata = dl.get_metadata(info_raw)
-        original_artist = metadata['artist']
-        original_comment = metadata['comment']
-
-        metadata['albumartist'] = METADATA_ALBUM_ARTIST
-        metadata['artist'] = '/'.join(update_artists(original_artist))
-        metadata['comment'] = (f'{date.year:04d}-{date.month:02d}-{date.day:02d} 第{episode}回\n\n'
-                               f'{original_comment}')
-        arts = [
-            os.path.join(project_name, dl.filename_from_url(info_json['episode']['chapters'][0]['pc_image_url'])),
-            os.path.join(project_name, dl.filename_from_url(info_json['episode']['episode_parts'][0]['pc_image_url'])),
-        ]
-        if main is not None:
-            metadata['song'] = f'しゅわラジ {episode:04d}'
-            print(f'main metadata: {metadata}')
-            mp4tools.write_tags(main, metadata, wipe=True)
-            mp4tools.write_arts(main, arts, wipe=True)
-            mp4tools.optimize(main)
-        if additional is not None:
-            metadata['song'] = f'しゅわラジ {episode:04d} 楽屋裏'
-            print(f'additional metadata: {metadata}')
-            mp4tools.write_tags(additional, metadata, wipe=True)
-            mp4tools.write_arts(additional, arts, wipe=True)
-            mp4tools.optimize(additional)
-
-        # copy main & additional to deploy path
-        if main is not None:
-            main_dist = os.path.join(AUDIO_DIR, f'{AUDIO_NAME_PREFIX}-{episode:04d}-main.m4a')
-            print(f'copy main to {main_dist}')
-            os.rename(main, main_dist)
-        if additional is not None:
-            additional_dist = os.path.join(AUDIO_DIR, f'{AUDIO_NAME_PREFIX}-{episode:04d}-additional.m4a')
-            print(f'copy additional to {additional_dist}')
-            os.rename(additional, additional_dist)
-
-        # update podcast file
-        print(f'update podcast file')
-        podcast_dict = save.get('podcast', None)
-        if podcast_dict is None:
-            print('warning: generating new podcast file')
-            pd = get_default_podcast()
-        else:
-            pd = Podcast.from_dict(podcast_dict)
-        pd.description = info_json['description'].strip().replace('\r\n', '\n')
-        if main is not None:
-            video_id = info_json['episode']['video']['id']
-            duration = int(info_json['episode']['video']['duration'])
-            pd.episodes.append(PodcastEpisode(
-                title=f'しゅわラジ {episode:04d}',
-                url=f'{AUDIO_URL_PREFIX}{AUDIO_NAME_PREFIX}-{episode:04d}-main.m4a',
-                type='audio/mp4',
-                file_length=os.path.getsize(main_dist),
-                description=original_comment,
-                guid=f'pstl-{episode}-{video_id}-main',
-                duration=duration,
-                pub_date=int(date.timestamp()),
-            ))
-        if additional is not None:
-            video_id = info_json['episode']['additional_video']['id']
-            duration = int(info_json['episode']['additional_video']['duration'])
-            pd.episodes.append(PodcastEpisode(
-                title=f'しゅわラジ {episode:04d} 楽屋裏',
-                url=f'{AUDIO_URL_PREFIX}{AUDIO_NAME_PREFIX}-{episode:04d}-additional.m4a',
-                type='audio/mp4',
-                file_length=os.path.getsize(additional_dist),
-                description=original_comment,
-                guid=f'pstl-{episode}-{video_id}-additional',
-                duration=duration,
-                pub_date=int(date.timestamp()),
-            ))
-        with open(PODCAST_FILE, 'w', encoding='utf-8') as f:
-            pd.generate_xml_file(f)
-        podcast_dict = pd.to_dict()
-
-        # generate wikitext
-        print(f'generate wikitext')
-        wikitext = gen_table(info_json)
-        out.append(f'wikitext:\n{wikitext}')
-
-        # finally update save data
-        save['last_episode'] = episode
-        save['podcast'] = podcast_dict
-
-    # remove project (be careful when testing)
-    print(f'remove project "{project_name}"')
-    shutil.rmtree(project_name)
-
-    # need wxpush dev account for WeChat notification https://wxpusher.zjiecode.com/
-    if out:
-        out.insert(0, 'Shuwarin Radio scraping report')
-        out_str = ('\n' + '=' * 20 + '\n').join(out)
-        # out_str = out_str.replace('<', '&lt;')
-        print(f'Send report:\n{out_str}')
-        sendNotification(out_str, summary='Shuwarin Radio scraping report')
-
-    print(f'All done!!!')
+    handler_generic.run(data, DEFAULTS)
 
 
 def update_podcast():
-    print(f'update podcast file')
-
-    with open('config.json', 'r', encoding='utf-8') as f:
-        config = json.load(f).get('program_config', {}).get('pstl', {})
-    globals().update(config)
-
-    with open('save.json', 'r', encoding='utf-8') as f:
-        save = json.load(f)['pstl']['callback_save']
-
-    podcast_dict = save.get('podcast', None)
-    if podcast_dict is None:
-        raise ValueError('no podcast data')
-    else:
-        pd = Podcast.from_dict(podcast_dict)
-    with open(PODCAST_FILE, 'w', encoding='utf-8') as f:
-        pd.generate_xml_file(f)
+    handler_generic.update_podcast('pstl', DEFAULTS)
 
 
 if __name__ == '__main__':
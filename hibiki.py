@@ -1,14 +1,24 @@
+import concurrent.futures
 import datetime
+import hashlib
 import os
 import re
 import subprocess
 import json
 import typing
+from dataclasses import dataclass
 
 import requests
 import m3u8
 
-from download import DownloaderOptions, DownloadQueue
+from archive import ArchiveOptions, StreamingArchive, create_archive
+from archive_store import ArchiveStore, StoreArchive
+from download import DownloaderOptions, DownloadQueue, mounted_session_factory
+import image_cache
+from image_cache import ImageCache
+import tools
+import scheduler
+import tracing
 
 # UA = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:88.0) Gecko/20100101 Firefox/88.0'
 
@@ -16,6 +26,12 @@ type_keys_dict = typing.Dict[str, bytes]
 type_download_list = typing.List[typing.Tuple[str, str]]
 
 
+@dataclass
+class RemuxResult:
+    filename: str  # output, including dirname
+    error: typing.Optional[str] = None
+
+
 class Downloader:
     Empty = object()
 
@@ -68,6 +84,7 @@ class Downloader:
 
         return dt, episode_index
 
+    @tracing.traced(cat='network')
     def create_project(self, program_info_raw: bytes, dirname):
         # program_info_json, program_info_raw = self._get_program_info(program_name)
         program_info_json = json.loads(program_info_raw.decode('utf-8'))
@@ -274,7 +291,9 @@ class Downloader:
 
         return m3u8_playlist_content, m3u8_variant_content, m3u8_patched_content, key_dict, download_list
 
-    def download(self, dirname):
+    @scheduler.resource('network')
+    @tracing.traced(cat='network')
+    def download(self, dirname, archive: typing.Union[StreamingArchive, StoreArchive] = None):
         with open(os.path.join(dirname, 'project.json'), 'r', encoding='utf-8') as f:
             project = json.load(f)
         queue_new = []
@@ -295,7 +314,12 @@ class Downloader:
         opt.min_rate = 1
         # opt.queue_size = 8
         opt.hide_progress_bar = True
-        dq = DownloadQueue(queue_new, opt)
+
+        def callback(i, success, info):
+            if success and archive is not None:
+                archive.commit(queue_new[i][2])
+
+        dq = DownloadQueue(queue_new, opt, callback, mounted_session_factory(self.session))
         try:
             dq.run()
         finally:
@@ -319,46 +343,70 @@ class Downloader:
         else:
             print('All files done')
 
-    def remux(self, dirname, ignore_missing=False):
+    @tracing.traced(cat='cpu')
+    def remux(self, dirname, ignore_missing=False, max_workers=None) -> typing.Dict[str, RemuxResult]:
+        """Remux each stream to `{prefix}out.m4a`, streams in parallel (each ffmpeg takes a cpu slot).
+
+        Return {stream name: RemuxResult}, a failed stream does not stop the others.
+        """
         with open(os.path.join(dirname, 'project.json'), 'r', encoding='utf-8') as f:
             project = json.load(f)
+        streams = {stream['stream_name']: stream for stream in project['streams']}
+        files = set(os.listdir(dirname))
 
-        files = os.listdir(dirname)
-        for stream in project['streams']:
-            print('Checking...')
+        def run(stream_name):
+            stream = streams[stream_name]
+            filename = f'{stream["prefix"]}out.m4a'
+            result = RemuxResult(os.path.join(dirname, filename))
             if not ignore_missing:
-                missing = []
-                for url, filename in stream['download_list']:
-                    if filename not in files:
-                        missing.append(filename)
+                missing = [x for url, x in stream['download_list'] if x not in files]
                 if missing:
-                    print(f'{len(missing)} files missing, abort')
-                    return
+                    result.error = f'{len(missing)} files missing'
+                    return result
 
-            prefix = stream['prefix']
-            filename = f'{prefix}out.m4a'
-            print(f'Saving to "{filename}"')
-
-            args = ['ffmpeg', '-hide_banner', '-y',
+            print(f'{stream_name}: saving to "{filename}"')
+            args = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
                     '-allowed_extensions', 'ALL',  # needed for .key keyfiles
                     '-i', stream['patched_file'],
                     '-c', 'copy',
                     '-movflags', '+faststart',
                     filename]
-            p = subprocess.run(args, cwd=dirname)
+            with scheduler.slot('cpu'):
+                p = subprocess.run(args, cwd=dirname)
             if p.returncode != 0:
-                print('Something went wrong!')
-            else:
-                print('Done!')
-
-    def download_images(self, dirname):
-        print('start downloading images')
-        with open(os.path.join(dirname, 'project.json'), 'r', encoding='utf-8') as f:
-            project = json.load(f)
-
-        with open(os.path.join(dirname, project['info_json']), 'r', encoding='utf-8') as f:
-            info_json = json.load(f)
-
+                result.error = f'ffmpeg failed ({p.returncode})'
+            return result
+
+        results = tools.parallel_map(run, streams, max_workers)
+        for stream_name, result in results.items():
+            print(f'{stream_name}: remux {"failed, " + result.error if result.error else "done"}')
+        return results
+
+    @tracing.traced(cat='cpu')
+    def transcode(self, jobs: typing.Sequence[typing.Tuple[str, str, typing.Sequence[str]]], max_workers=None) \
+            -> typing.List[bool]:
+        """Run ffmpeg for each (input file, output file, output args) in parallel, return success of each job.
+
+        At most max_workers (default cpu count) jobs run at once, each job takes a cpu slot.
+        """
+        def run(job):
+            src, dst, args = job
+            cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-i', src, '-vn', *args, dst]
+            with scheduler.slot('cpu'):
+                p = subprocess.run(cmd)
+            if p.returncode != 0:
+                print(f'transcode "{dst}" failed ({p.returncode})')
+                return False
+            print(f'transcoded "{dst}"')
+            return True
+
+        if not jobs:
+            return []
+        max_workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+        with concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='Transcode') as pool:
+            return list(pool.map(run, jobs))
+
+    def get_image_urls(self, info_json):
         paths = [
             ('pc_image_url',),
             ('sp_image_url',),
@@ -374,15 +422,37 @@ class Downloader:
             url_found = list(self._try_json_path(info_json, path))
             print(f'found {url_found} at path {path}')
             urls.update(url_found)
+        return urls
 
-        for url in urls:
-            print(f'download "{url}"')
+    @scheduler.resource('network')
+    @tracing.traced(cat='network')
+    def download_images(self, dirname, archive: typing.Union[StreamingArchive, StoreArchive] = None,
+                        cache: ImageCache = None, max_workers=8):
+        print('start downloading images')
+        with open(os.path.join(dirname, 'project.json'), 'r', encoding='utf-8') as f:
+            project = json.load(f)
+
+        with open(os.path.join(dirname, project['info_json']), 'r', encoding='utf-8') as f:
+            info_json = json.load(f)
+
+        def fetch(url):
             filename = os.path.join(dirname, self.filename_from_url(url))
             if os.access(filename, os.F_OK):
                 print(f'removing existent file "{filename}"')
                 os.remove(filename)
-            p = subprocess.run(('wget', '-O', filename, url))
-            p.check_returncode()
+            if cache is not None:
+                tools.clone_file(cache.fetch(url), filename)
+            else:
+                image_cache.download(self.session, url, filename)
+                print(f'downloaded "{url}"')
+
+        urls = self.get_image_urls(info_json)
+        with concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='Image') as pool:
+            futures = {pool.submit(fetch, url): url for url in urls}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                if archive is not None:
+                    archive.commit(self.filename_from_url(futures[future]))
 
         print('download images done')
 
@@ -411,8 +481,78 @@ class Downloader:
             url = match.group(1)
         return url.replace('/', '%2F')
 
-    def archive(self, dirname):
-        print('start archiving to tar.xz')
+    def get_media_fingerprint(self, dirname):
+        """Hash of the media of a project: stream ids, segment URIs and durations, key URIs.
+
+        Query strings (e.g. access tokens) are ignored.
+        """
+        with open(os.path.join(dirname, 'project.json'), 'r', encoding='utf-8') as f:
+            project = json.load(f)
+        h = hashlib.sha256()
+        for stream in project['streams']:
+            h.update(f'stream {stream["stream_name"]} {stream["stream_id"]}\n'.encode('utf-8'))
+            with open(os.path.join(dirname, stream['variant_file']), 'rb') as f:
+                variant = m3u8.loads(f.read().decode('utf-8'))
+            for key in variant.keys:
+                if key is not None and key.uri is not None:
+                    h.update(f'key {key.uri.split("?")[0]}\n'.encode('utf-8'))
+            for segment in variant.segments:
+                h.update(f'segment {segment.uri.split("?")[0]} {segment.duration}\n'.encode('utf-8'))
+        return h.hexdigest()
+
+    def get_archive_members(self, dirname, metadata_only=False):
+        """Return (files, images) of a complete project, files in archive order.
+
+        With metadata_only, only json, playlists and keys (no segments and images).
+        """
+        with open(os.path.join(dirname, 'project.json'), 'r', encoding='utf-8') as f:
+            project = json.load(f)
+        with open(os.path.join(dirname, project['info_json']), 'r', encoding='utf-8') as f:
+            info_json = json.load(f)
+
+        files = [project['info_json'], 'project.json']
+        for stream in project['streams']:
+            files.append(stream['playlist_file'])
+            files.append(stream['variant_file'])
+            files.append(stream['patched_file'])
+            files.extend(stream['key_files'])
+            if not metadata_only:
+                files.extend(filename for url, filename in stream['download_list'])
+        if metadata_only:
+            return files, []
+        images = sorted({self.filename_from_url(url) for url in self.get_image_urls(info_json)})
+        return files + images, images
+
+    def open_archive(self, dirname, options: ArchiveOptions = None, store: ArchiveStore = None,
+                     metadata_only=False, open_mirror=None) -> typing.Union[StreamingArchive, StoreArchive]:
+        """Start archiving a project while downloading, pass the result to `download` and `download_images`.
+
+        Archive to `{dirname}.tar.xz` (or other extension), or to `store` if given.
+        With metadata_only, archive to `{dirname}.meta.tar.xz` without segments and images.
+        open_mirror(archive_file): returns the mirror of StreamingArchive (not used with a store).
+        """
+        options = options or ArchiveOptions()
+        members, images = self.get_archive_members(dirname, metadata_only)
+        if store is not None:
+            print(f'start archiving to store "{store.root}" while downloading')
+            archive = store.open_project(dirname, members)
+        else:
+            archive_file = f'{dirname}{".meta" if metadata_only else ""}{options.get_extension()}'
+            print(f'start archiving to {archive_file} while downloading')
+            archive = StreamingArchive(dirname, archive_file, members, options,
+                                       open_mirror(archive_file) if open_mirror is not None else None)
+        # files from create_project (or downloaded in a previous run) are complete,
+        # images will be downloaded again
+        files = set(os.listdir(dirname))
+        for name in members:
+            if name in files and name not in images:
+                archive.commit(name)
+        return archive
+
+    @tracing.traced(cat='cpu')
+    def archive(self, dirname, options: ArchiveOptions = None):
+        options = options or ArchiveOptions()
+        print(f'start archiving to {options.get_extension()}')
         with open(os.path.join(dirname, 'project.json'), 'r', encoding='utf-8') as f:
             project = json.load(f)
 
@@ -427,21 +567,9 @@ class Downloader:
                 os.remove(fullname)
 
         # do archive
-        archive_file = f'{dirname}.tar.xz'
-        print(f'archiving to {archive_file}')
-        try:
-            with open(archive_file, 'wb') as f:
-                tar = subprocess.Popen(('tar', '-c', dirname), stdout=subprocess.PIPE)
-                xz = subprocess.Popen(('xz', '-9', '-e'), stdin=tar.stdout, stdout=f)
-                tar.stdout.close()
-                tar.wait()
-                xz.wait()
-                assert tar.returncode == 0
-                assert xz.returncode == 0
-        except Exception:
-            if os.access(archive_file, os.F_OK):
-                os.remove(archive_file)
-            raise
+        archive_file = f'{dirname}{options.get_extension()}'
+        create_archive(dirname, archive_file, options)
+        return archive_file
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+"""persistent cache for images, revalidated with conditional requests (ETag / Last-Modified)
+
+Layout of the cache directory:
+  <sha256(url)[:2]>/<sha256(url)>       cached content
+  <sha256(url)[:2]>/<sha256(url)>.json  url and validators
+"""
+
+import hashlib
+import json
+import os
+import threading
+import typing
+
+import requests
+
+TIMEOUT = (10, 30)
+
+
+def download(session: requests.Session, url, filename, headers: typing.Dict[str, str] = None) \
+        -> requests.Response:
+    """Download url to filename (via temp file). Nothing is written on 304 Not Modified."""
+    with session.get(url, headers=headers, timeout=TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        if r.status_code == 304:
+            return r
+        temp_filename = f'{filename}.{threading.get_ident()}.download'
+        try:
+            with open(temp_filename, 'wb') as f:
+                for chunk in r.iter_content(64 * 1024):
+                    f.write(chunk)
+            os.replace(temp_filename, filename)
+        finally:
+            if os.access(temp_filename, os.F_OK):
+                os.remove(temp_filename)
+    return r
+
+
+class ImageCache:
+    def __init__(self, cache_dir, session: requests.Session):
+        self.cache_dir = cache_dir
+        self.session = session
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def fetch(self, url) -> str:
+        """Return filename of the (revalidated) cached content of url."""
+        path = self._path(url)
+        meta_path = f'{path}.json'
+        headers = {}
+        if os.access(path, os.F_OK):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                meta = {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        r = download(self.session, url, path, headers)
+        if r.status_code == 304:
+            print(f'not modified "{url}"')
+            return path
+        meta = {
+            'url': url,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+        }
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        print(f'downloaded "{url}"')
+        return path
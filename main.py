@@ -3,12 +3,15 @@
 # 3. test: need update?
 # 4. do work
 
+import concurrent.futures
 import importlib
 import json
 import time
 
 import requests
 
+import scheduler
+import tracing
 import wxpush
 
 
@@ -34,8 +37,9 @@ class Loader:
 
     def run(self, program_name, save, program_config):
         # run with "live" json info
-        info_json, info_raw = self.get_program_info(program_name)
-        return self._run_implementation(program_name, save, program_config, info_json, info_raw)
+        with tracing.span('Loader.run', program=program_name):
+            info_json, info_raw = self.get_program_info(program_name)
+            return self._run_implementation(program_name, save, program_config, info_json, info_raw)
 
     def run_archived(self, program_name, save, program_config, info_raw_list):
         # run with "archived" json info
@@ -61,8 +65,10 @@ class Loader:
         ):
             # changed, load handler
             print(f'new episode {episode_id} ({episode_name}, {episode_time})')
-            handler = importlib.import_module(f'handler_{program_name}')
+            # program specific handler_<program>.py, or e.g. {"handler": "generic"} in program_config
+            handler = importlib.import_module(f'handler_{program_config.get("handler", program_name)}')
             data = {
+                'program_name': program_name,
                 'info_raw': info_raw,
                 'info_json': info_json,
                 'session': self.session,
@@ -107,34 +113,64 @@ def main():
     loader = Loader(config['main_config'])
     wxpush.WxPusher_TOKEN = config['main_config']['push']['token']
     wxpush.WxPusher_UIDs = config['main_config']['push']['uid_list']
-
-    save_changed = False
-    first = True
-    for program_name in programs:
-        if first:
-            first = False
-        else:
-            print('')
-
+    wxpush.WxPusher_URL = config['main_config']['push'].get('url', wxpush.WxPusher_URL)
+    # e.g. "resources": {"network": 2, "cpu": 4}, slots shared by all programs (see scheduler.py)
+    scheduler.configure(config['main_config'].get('resources', {}))
+    # e.g. "trace": "trace.json", spans of this run in Chrome trace format (open in https://ui.perfetto.dev)
+    trace_file = config['main_config'].get('trace')
+    if trace_file:
+        tracing.start()
+
+    def check_program(program_name):
         print(f'check program {program_name}')
-        try:
-            program_save = save.setdefault(program_name, {})
-            program_config = config.get('program_config', {}).get(program_name, {})
-            has_new = loader.run(program_name, program_save, program_config)
-            if has_new:
+        # notifications of this program run are pushed as one message
+        with wxpush.batch():
+            try:
+                program_save = save.setdefault(program_name, {})
+                program_config = config.get('program_config', {}).get(program_name, {})
+                return loader.run(program_name, program_save, program_config)
+            except Exception:
+                # hint: you may want to "raise" here when debugging
+                import traceback
+                exc_text = traceback.format_exc()
+                print(f'Exception:\n{exc_text}')
+                wxpush.sendNotification(f'HiBiKi scraping exception:\n{exc_text}',
+                                        summary='HiBiKi scraping exception')
+                return False
+
+    # programs are independent (own project folder, config and save), may run concurrently
+    max_programs = config['main_config'].get('max_programs', 1)
+    if max_programs > 1:
+        for program_name in programs:
+            save.setdefault(program_name, {})
+        with concurrent.futures.ThreadPoolExecutor(max_programs) as pool:
+            save_changed = any(list(pool.map(check_program, programs)))
+    else:
+        save_changed = False
+        first = True
+        for program_name in programs:
+            if first:
+                first = False
+            else:
+                print('')
+            if check_program(program_name):
                 save_changed = True
-        except Exception:
-            # hint: you may want to "raise" here when debugging
-            import traceback
-            exc_text = traceback.format_exc()
-            print(f'Exception:\n{exc_text}')
-            wxpush.sendNotification(f'HiBiKi scraping exception:\n{exc_text}',
-                                    summary='HiBiKi scraping exception')
+
+    if max_programs > 1:
+        scheduler.get_scheduler().report()
 
     if save_changed:
         with open('save.json', 'w', encoding='utf-8') as f:
             json.dump(save, f, ensure_ascii=False, indent=4)
 
+    if trace_file:
+        tracer = tracing.stop()
+        tracer.export_chrome(trace_file)
+        tracer.print_summary()
+
+    # notifications are sent in background, wait for them (bounded)
+    wxpush.flush()
+
 
 def main_archived():
     print('')
@@ -6,6 +6,9 @@ https://github.com/TechSmith/mp4v2
 import subprocess
 import typing
 
+import scheduler
+import tracing
+
 ACCEPTED_TAGS = {
     'A', 'album',
     'a', 'artist',
@@ -47,6 +50,8 @@ ACCEPTED_TAGS = {
 }
 
 
+@scheduler.resource('cpu')
+@tracing.traced(cat='cpu')
 def write_tags(filename, tags: typing.Dict[str, typing.Any], wipe=True, ignore_unknown=False):
     # check tags
     tags_command = []
@@ -66,6 +71,8 @@ def write_tags(filename, tags: typing.Dict[str, typing.Any], wipe=True, ignore_u
     p.check_returncode()
 
 
+@scheduler.resource('cpu')
+@tracing.traced(cat='cpu')
 def write_arts(filename, arts: typing.Union[str, typing.Iterable[str]], wipe=True):
     if isinstance(arts, str):
         arts = (arts,)
@@ -78,6 +85,8 @@ def write_arts(filename, arts: typing.Union[str, typing.Iterable[str]], wipe=Tru
         p.check_returncode()
 
 
+@scheduler.resource('cpu')
+@tracing.traced(cat='cpu')
 def optimize(filename):
     p = subprocess.run(['mp4file', '--optimize', filename])
     p.check_returncode()
@@ -0,0 +1,185 @@
+"""small stage DAG executor
+
+Stages declare their dependencies, independent stages run concurrently.
+A stage function is called with a dict {dependency name: dependency result}.
+
+With a Checkpoint, completed stages (and their results) are recorded,
+a rerun continues at the first incomplete stage.
+
+A stage which failed (or was interrupted) is run again from the start, so stages must be idempotent:
+e.g. a stage moving its input files must accept that some were already moved by the failed run.
+Keep side effects which may fail independently (uploads, database writes) in stages of their own.
+"""
+
+import concurrent.futures
+import json
+import os
+import time
+import typing
+from dataclasses import dataclass, field
+
+import tracing
+
+
+class Checkpoint:
+    """Completed stages and their results, stored in a json file (e.g. in the project directory).
+
+    State recorded with another fingerprint (different input) is ignored.
+    """
+
+    def __init__(self, filename, fingerprint: str):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.stages: typing.Dict[str, dict] = {}
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            print(f'warning: broken checkpoint "{filename}", ignored')
+            return
+        if state.get('fingerprint') == fingerprint:
+            self.stages = state.get('stages', {})
+        else:
+            print(f'checkpoint "{filename}" is for different input, ignored')
+
+    def is_done(self, name, fingerprint=None):
+        return name in self.stages and self.stages[name].get('fingerprint') == fingerprint
+
+    def get(self, name):
+        return self.stages[name]['result']
+
+    def mark(self, name, result, fingerprint=None):
+        self.stages[name] = {
+            'result': result,
+            'fingerprint': fingerprint,
+            'time': int(time.time()),
+        }
+        temp_filename = f'{self.filename}.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': self.fingerprint, 'stages': self.stages}, f, ensure_ascii=False, indent=1)
+        os.replace(temp_filename, self.filename)
+
+
+@dataclass
+class Stage:
+    name: str
+    func: typing.Callable[[dict], typing.Any]
+    deps: typing.Tuple[str, ...] = ()
+    # record completion in Checkpoint (result must be json serializable);
+    # stages without checkpoint (e.g. returning open files) only run when a dependent stage runs
+    checkpoint: bool = True
+    fingerprint: typing.Optional[str] = None  # recorded result is only reused with the same fingerprint
+
+    resumed: bool = field(default=False, repr=False)
+    start: typing.Optional[float] = field(default=None, repr=False)
+    end: typing.Optional[float] = field(default=None, repr=False)
+    status: str = field(default='pending', repr=False)
+
+
+class Pipeline:
+    def __init__(self, name='pipeline', max_threads=4):
+        self.name = name
+        self.max_threads = max_threads
+        self.stages: typing.Dict[str, Stage] = {}
+        self.results: typing.Dict[str, typing.Any] = {}
+        self._start = None
+
+    def add(self, name, func, deps: typing.Iterable[str] = (), checkpoint=True, fingerprint=None):
+        if name in self.stages:
+            raise ValueError(f'Duplicated stage: {name}')
+        deps = tuple(deps)
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f'Unknown dependency of {name}: {dep}')
+        self.stages[name] = Stage(name, func, deps, checkpoint, fingerprint)
+        return self
+
+    def stage(self, name=None, deps: typing.Iterable[str] = (), checkpoint=True, fingerprint=None):
+        """Decorator version of `add`."""
+        def decorator(func):
+            self.add(name or func.__name__, func, deps, checkpoint, fingerprint)
+            return func
+        return decorator
+
+    def _resume(self, checkpoint: Checkpoint):
+        for stage in self.stages.values():
+            if stage.checkpoint and checkpoint.is_done(stage.name, stage.fingerprint):
+                stage.status = 'done'
+                stage.resumed = True
+                self.results[stage.name] = checkpoint.get(stage.name)
+        # stages are added after their dependencies, walk backwards
+        needed = set()
+        for stage in reversed(list(self.stages.values())):
+            if stage.status != 'done' and (stage.checkpoint or stage.name in needed):
+                needed.add(stage.name)
+                needed.update(stage.deps)
+        for stage in self.stages.values():
+            if stage.status == 'pending' and stage.name not in needed:
+                stage.status = 'skipped'
+        resumed = [x.name for x in self.stages.values() if x.resumed]
+        if resumed:
+            print(f'[{self.name}] resume, completed stages: {", ".join(resumed)}')
+
+    def _ready(self):
+        for stage in self.stages.values():
+            if stage.status == 'pending' and all(self.stages[d].status == 'done' for d in stage.deps):
+                yield stage
+
+    def _call(self, stage: Stage, inputs):
+        with tracing.span(f'stage {stage.name}', 'pipeline', pipeline=self.name):
+            return stage.func(inputs)
+
+    def run(self, checkpoint: Checkpoint = None) -> typing.Dict[str, typing.Any]:
+        """Run all stages, return their results. The first exception is raised after running stages finished."""
+        self._start = time.perf_counter()
+        if checkpoint is not None:
+            self._resume(checkpoint)
+        pool = concurrent.futures.ThreadPoolExecutor(self.max_threads, thread_name_prefix=self.name)
+        running: typing.Dict[concurrent.futures.Future, Stage] = {}
+        error = None
+        try:
+            while True:
+                if error is None:
+                    for stage in list(self._ready()):
+                        inputs = {d: self.results[d] for d in stage.deps}
+                        print(f'[{self.name}] stage {stage.name} start')
+                        stage.status = 'running'
+                        stage.start = time.perf_counter()
+                        running[pool.submit(self._call, stage, inputs)] = stage
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    stage.end = time.perf_counter()
+                    try:
+                        self.results[stage.name] = future.result()
+                    except BaseException as e:
+                        stage.status = 'failed'
+                        print(f'[{self.name}] stage {stage.name} failed: {e!r}')
+                        if error is None:
+                            error = e
+                    else:
+                        stage.status = 'done'
+                        print(f'[{self.name}] stage {stage.name} done ({stage.end - stage.start:.2f}s)')
+                        if checkpoint is not None and stage.checkpoint:
+                            checkpoint.mark(stage.name, self.results[stage.name], stage.fingerprint)
+        finally:
+            pool.shutdown()
+            self.report()
+        if error is not None:
+            raise error
+        return self.results
+
+    def report(self):
+        print(f'[{self.name}] stage timing:')
+        for stage in self.stages.values():
+            if stage.start is None:
+                print(f'  {stage.name:<20} {"resumed" if stage.resumed else stage.status}')
+            else:
+                end = stage.end if stage.end is not None else time.perf_counter()
+                print(f'  {stage.name:<20} {stage.status:<8} '
+                      f'start {stage.start - self._start:8.2f}s  took {end - stage.start:8.2f}s')
+        print(f'  {"(total)":<20} {time.perf_counter() - self._start:.2f}s')
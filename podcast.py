@@ -1,10 +1,76 @@
 import dataclasses
+import hashlib
+import importlib.util
+import json
+import os
 import typing
 from time import gmtime, strftime
 from typing import Optional, List
 import xml.etree.ElementTree as ET
 import io
 
+import tracing
+
+
+class FragmentCache:
+    """Rendered <item> of episodes, keyed by hash of episode fields.
+
+    Saved as json lines [key, fragment], new fragments are appended.
+    The file is rewritten without unused fragments when they are the majority.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.fragments: typing.Dict[str, str] = {}
+        self.used: typing.Set[str] = set()
+        self.new: typing.List[str] = []
+        self._broken = False
+        if filename is not None:
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            key, fragment = json.loads(line)
+                        except ValueError:
+                            print(f'warning: broken line in podcast cache "{filename}", ignored')
+                            self._broken = True
+                            continue
+                        self.fragments[key] = fragment
+            except FileNotFoundError:
+                pass
+
+    @property
+    def rendered(self):
+        return len(self.new)
+
+    def get(self, episode: 'PodcastEpisode', *, googleplay=True, itunes=True, normal=True) -> str:
+        key = episode.fingerprint(googleplay=googleplay, itunes=itunes, normal=normal)
+        self.used.add(key)
+        fragment = self.fragments.get(key)
+        if fragment is None:
+            fragment = episode.render_item(googleplay=googleplay, itunes=itunes, normal=normal)
+            self.fragments[key] = fragment
+            self.new.append(key)
+        return fragment
+
+    def save(self):
+        if self.filename is None:
+            return
+        if self._broken or len(self.fragments) - len(self.used) > len(self.used):
+            temp_filename = f'{self.filename}.tmp'
+            with open(temp_filename, 'w', encoding='utf-8') as f:
+                for key, fragment in self.fragments.items():
+                    if key in self.used:
+                        f.write(json.dumps([key, fragment], ensure_ascii=False) + '\n')
+            os.replace(temp_filename, self.filename)
+            self.fragments = {k: v for k, v in self.fragments.items() if k in self.used}
+            self._broken = False
+        elif self.new:
+            with open(self.filename, 'a', encoding='utf-8') as f:
+                for key in self.new:
+                    f.write(json.dumps([key, self.fragments[key]], ensure_ascii=False) + '\n')
+        self.new = []
+
 
 @dataclasses.dataclass
 class Podcast:
@@ -34,14 +100,24 @@ class Podcast:
         return self
 
     def to_dict(self):
-        return dataclasses.asdict(self)
+        # shallow, dataclasses.asdict deep-copies every episode
+        d = {k: v for k, v in self.__dict__.items() if k != 'episodes'}
+        d['episodes'] = [x.to_dict() for x in self.episodes]
+        return d
 
-    def generate_xml(self, *, googleplay=True, itunes=True, normal=True) -> str:
+    def generate_xml(self, *, googleplay=True, itunes=True, normal=True, cache: FragmentCache = None) -> str:
         out = io.StringIO()
-        self.generate_xml_file(out, googleplay=googleplay, itunes=itunes, normal=normal)
+        self.generate_xml_file(out, googleplay=googleplay, itunes=itunes, normal=normal, cache=cache)
         return out.getvalue()
 
-    def generate_xml_file(self, f: typing.TextIO, *, googleplay=True, itunes=True, normal=True) -> None:
+    @tracing.traced()
+    def generate_xml_file(self, f: typing.TextIO, *, googleplay=True, itunes=True, normal=True,
+                          cache: FragmentCache = None, links: typing.Sequence[typing.Tuple[str, str]] = (),
+                          archive=False) -> None:
+        """Write RSS to f. With cache, <item> of unchanged episodes are not rendered again.
+
+        links: (rel, href) of feed pages, archive: mark as archive document (RFC 5005).
+        """
         root_tags = {
             'version': '2.0'
         }
@@ -49,6 +125,12 @@ class Podcast:
             root_tags['xmlns:googleplay'] = 'http://www.google.com/schemas/play-podcasts/1.0'
         if googleplay or itunes:
             root_tags['xmlns:itunes'] = 'http://www.itunes.com/dtds/podcast-1.0.dtd'
+        if links:
+            root_tags['xmlns:atom'] = 'http://www.w3.org/2005/Atom'
+        if archive:
+            root_tags['xmlns:fh'] = 'http://purl.org/syndication/history/1.0'
+        if any(eps.alternates for eps in self.episodes):
+            root_tags['xmlns:podcast'] = 'https://podcastindex.org/namespace/1.0'
         root = ET.Element('rss', root_tags)
         channel = ET.SubElement(root, 'channel')
 
@@ -93,12 +175,182 @@ class Podcast:
         if self.new_feed_url is not None:
             if googleplay or itunes:
                 ET.SubElement(channel, 'itunes:new-feed-url').text = self.new_feed_url
+        if archive:
+            ET.SubElement(channel, 'fh:archive')
+        for rel, href in links:
+            ET.SubElement(channel, 'atom:link', rel=rel, href=href)
+
+        if cache is None:
+            for eps in reversed(self.episodes):
+                eps.generate_xml(channel, googleplay=googleplay, itunes=itunes, normal=normal)
 
+            tree = ET.ElementTree(root)
+            tree.write(f, encoding='unicode', xml_declaration=True)
+            return
+
+        # header (channel without items), cached items, footer
+        out = io.StringIO()
+        ET.ElementTree(root).write(out, encoding='unicode', xml_declaration=True)
+        head, tail = out.getvalue().rsplit('</channel>', 1)
+        f.write(head)
         for eps in reversed(self.episodes):
-            eps.generate_xml(channel, googleplay=googleplay, itunes=itunes, normal=normal)
+            f.write(cache.get(eps, googleplay=googleplay, itunes=itunes, normal=normal))
+        f.write('</channel>')
+        f.write(tail)
+
+    @tracing.traced()
+    def write_pages(self, filename, page_size, url_prefix, state: dict, *, googleplay=True, itunes=True,
+                    normal=True, cache: FragmentCache = None, writer: 'FeedWriter' = None) -> typing.List[str]:
+        """Write a paged feed (RFC 5005 archived feed), return the written files.
+
+        filename (e.g. podcast.rss) gets the latest episodes, older episodes are in archive pages
+        podcast-0001.rss (oldest), podcast-0002.rss, ... of page_size episodes each.
+        url_prefix: Web URL of the directory of filename.
+        state: persisted by the caller, archive pages are only rewritten when their episodes, links
+        or the channel changed.
+        """
+        writer = writer or FeedWriter()
+        dirname, basename = os.path.split(filename)
+        stem, ext = os.path.splitext(basename)
+        page_count = (len(self.episodes) - 1) // page_size if self.episodes else 0
+
+        def page_name(i):
+            return f'{stem}-{i:04d}{ext}'
+
+        pages = []
+        for i in range(1, page_count + 1):
+            links = [('current', url_prefix + basename)]
+            if i > 1:
+                links.append(('prev-archive', url_prefix + page_name(i - 1)))
+            if i < page_count:
+                links.append(('next-archive', url_prefix + page_name(i + 1)))
+            pages.append((page_name(i), self.episodes[(i - 1) * page_size:i * page_size], links, True))
+        links = [('prev-archive', url_prefix + page_name(page_count))] if page_count else []
+        pages.append((basename, self.episodes[page_count * page_size:], links, False))
 
-        tree = ET.ElementTree(root)
-        tree.write(f, encoding='unicode', xml_declaration=True)
+        channel = repr(dataclasses.replace(self, episodes=[]))  # channel fields are in every page
+        written = []
+        for name, episodes, links, archive in pages:
+            path = os.path.join(dirname, name)
+            if archive:
+                h = hashlib.sha1(repr((channel, links, googleplay, itunes, normal)).encode('utf-8'))
+                for eps in episodes:
+                    h.update(eps.fingerprint(googleplay=googleplay, itunes=itunes, normal=normal).encode('utf-8'))
+                digest = h.hexdigest()
+                if state.get(name) == digest and os.access(path, os.F_OK):
+                    continue
+                state[name] = digest
+            page = dataclasses.replace(self, episodes=episodes)
+            out = io.StringIO()
+            page.generate_xml_file(out, googleplay=googleplay, itunes=itunes, normal=normal,
+                                   cache=cache, links=links, archive=archive)
+            if writer.write(path, out.getvalue()):
+                written.append(path)
+        names = {x[0] for x in pages}
+        for name in list(state):
+            if name not in names:
+                del state[name]
+        return written
+
+
+class FeedWriter:
+    """Write feed files atomically, with precompressed sidecars and a manifest of validators.
+
+    For podcast.rss: podcast.rss.gz, podcast.rss.br (needs brotli), and entries in manifest_file:
+    {name: {size, sha256, etag, encodings: {gzip: {file, size, etag}, br: {...}}}}.
+    A file which would not change is not written again (mtime stays).
+    """
+
+    ENCODINGS = {
+        'gz': 'gzip',
+        'br': 'br',
+    }
+
+    def __init__(self, compress: typing.Iterable[str] = (), manifest_file=None):
+        self.compress = list(compress)
+        for ext in self.compress:
+            if ext not in self.ENCODINGS:
+                raise ValueError(f'Unknown compression: {ext}')
+        if 'br' in self.compress and importlib.util.find_spec('brotli') is None:
+            print('warning: brotli is not installed, .br files are not generated')
+            self.compress.remove('br')
+        self.manifest_file = manifest_file
+        self.manifest: typing.Dict[str, dict] = {}
+        self._changed = False
+        if manifest_file is not None:
+            try:
+                with open(manifest_file, 'r', encoding='utf-8') as f:
+                    self.manifest = json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                print(f'warning: broken manifest "{manifest_file}", ignored')
+
+    @staticmethod
+    def _replace(filename, content: bytes):
+        temp_filename = f'{filename}.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(content)
+        os.replace(temp_filename, filename)
+
+    @staticmethod
+    def _compress(ext, content: bytes) -> bytes:
+        if ext == 'gz':
+            import gzip
+            return gzip.compress(content, 9, mtime=0)
+        import brotli
+        return brotli.compress(content)
+
+    def write(self, filename, text: str) -> bool:
+        """Write text to filename (and sidecars), return False if nothing changed."""
+        content = text.encode('utf-8')
+        digest = hashlib.sha256(content).hexdigest()
+        try:
+            with open(filename, 'rb') as f:
+                unchanged = f.read() == content
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            self._replace(filename, content)
+            for ext in self.ENCODINGS:
+                # stale sidecar of a disabled encoding
+                if ext not in self.compress and os.access(f'{filename}.{ext}', os.F_OK):
+                    os.remove(f'{filename}.{ext}')
+
+        name = os.path.basename(filename)
+        entry = {
+            'size': len(content),
+            'sha256': digest,
+            'etag': f'"{digest[:32]}"',
+            'encodings': {},
+        }
+        old_encodings = self.manifest.get(name, {}).get('encodings', {})
+        for ext in self.compress:
+            encoding = self.ENCODINGS[ext]
+            sidecar = f'{filename}.{ext}'
+            old = old_encodings.get(encoding)
+            if unchanged and old is not None and old.get('etag') == f'"{digest[:32]}-{ext}"' \
+                    and os.access(sidecar, os.F_OK):
+                entry['encodings'][encoding] = old
+                continue
+            compressed = self._compress(ext, content)
+            self._replace(sidecar, compressed)
+            entry['encodings'][encoding] = {
+                'file': os.path.basename(sidecar),
+                'size': len(compressed),
+                'etag': f'"{digest[:32]}-{ext}"',
+            }
+        if self.manifest.get(name) != entry:
+            self.manifest[name] = entry
+            self._changed = True
+        return not unchanged
+
+    def close(self):
+        """Save the manifest (if changed)."""
+        if self.manifest_file is not None and self._changed:
+            self._replace(self.manifest_file,
+                          json.dumps(self.manifest, ensure_ascii=False, indent=1).encode('utf-8'))
+            self._changed = False
 
 
 @dataclasses.dataclass
@@ -114,6 +366,8 @@ class PodcastEpisode:
     duration: Optional[int] = None
     pub_date: Optional[int] = None
     block: bool = False
+    # other renditions (podcast:alternateEnclosure), {url, type, length, bitrate (bps, optional), title (optional)}
+    alternates: List[dict] = dataclasses.field(default_factory=list)
 
     @classmethod
     def from_dict(cls, d: dict):
@@ -123,6 +377,23 @@ class PodcastEpisode:
                 self.__dict__[k] = v
         return self
 
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def fingerprint(self, *, googleplay=True, itunes=True, normal=True) -> str:
+        h = hashlib.sha1(f'{googleplay:d}{itunes:d}{normal:d}'.encode('utf-8'))
+        for k, v in self.__dict__.items():
+            # fields are str, int, bool, None or the list of alternates (dicts of str and int)
+            if k == 'alternates' and not v:
+                continue  # fingerprints of episodes without alternates (and caches) stay the same
+            h.update(f'\0{k}\0{type(v).__name__}\0{v}'.encode('utf-8'))
+        return h.hexdigest()
+
+    def render_item(self, *, googleplay=True, itunes=True, normal=True) -> str:
+        parent = ET.Element('channel')
+        self.generate_xml(parent, googleplay=googleplay, itunes=itunes, normal=normal)
+        return ET.tostring(parent[0], encoding='unicode')
+
     def generate_xml(self, channel_node, *, googleplay=True, itunes=True, normal=True) -> None:
         episode = ET.SubElement(channel_node, 'item')
         if self.guid is not None:
@@ -144,6 +415,14 @@ class PodcastEpisode:
                       url=self.url,
                       type=self.type,
                       length=str(self.file_length))
+        for alt in self.alternates:
+            attrib = {'type': alt['type'], 'length': str(alt['length'])}
+            if alt.get('bitrate') is not None:
+                attrib['bitrate'] = str(alt['bitrate'])
+            if alt.get('title') is not None:
+                attrib['title'] = alt['title']
+            node = ET.SubElement(episode, 'podcast:alternateEnclosure', attrib)
+            ET.SubElement(node, 'podcast:source', uri=alt['url'])
         # if self.explicit:
         #     pass
         if self.pub_date is not None:
@@ -0,0 +1,248 @@
+"""rebuild wikitext, podcast episode list and MP4 tags of a program from its archives
+
+Archived program_info.json files are read without decompressing the audio (indexed archives and
+store manifests; old archives without index are scanned until program_info.json).
+The latest program_info.json of each episode is used; episodes are processed on a process pool.
+
+usage: python rebuild.py <program> [wikitext] [podcast] [tags] [-j workers] [-o wikitext_file]
+  without wikitext / podcast / tags, all of them are rebuilt.
+  podcast rewrites PODCAST_FILE and the podcast in save.json (episodes which are not rebuilt are kept),
+  tags rewrites published files in AUDIO_DIR.
+"""
+
+import concurrent.futures
+import importlib
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import typing
+
+from archive import ArchiveReader
+from archive_store import ArchiveStore
+from catalog import Catalog
+import handler_generic
+from handler_generic import ProgramConfig
+import hibiki
+import mp4tools
+from podcast import Podcast, PodcastEpisode
+
+ARCHIVE_SUFFIXES = ('.tar.xz', '.tar.gz', '.tar')
+
+
+def list_sources(cfg: ProgramConfig) -> typing.List[typing.Tuple[str, str]]:
+    """Archives of the program, as (kind, reference): ('tar', filename) or ('store', manifest name)."""
+    sources = []
+    if not os.path.isdir(cfg.ARCHIVE_DIR):
+        return sources
+    prefix = f'{cfg.PROJECT_FOLDER_PREFIX}-'
+    for name in sorted(os.listdir(cfg.ARCHIVE_DIR)):
+        if name.startswith(prefix) and name.endswith(ARCHIVE_SUFFIXES):
+            sources.append(('tar', os.path.join(cfg.ARCHIVE_DIR, name)))
+    if os.path.isdir(os.path.join(cfg.ARCHIVE_DIR, 'manifests')):
+        store = ArchiveStore(cfg.ARCHIVE_DIR)
+        sources.extend(('store', x) for x in store.list_projects() if x.startswith(prefix))
+    return sources
+
+
+def read_members(cfg: ProgramConfig, kind, ref, names: typing.Iterable[str]) -> typing.Dict[str, bytes]:
+    """Read files (relative to the project directory) from an archive, missing files are left out."""
+    names = set(names)
+    if kind == 'store':
+        store = ArchiveStore(cfg.ARCHIVE_DIR)
+        return {x['name']: store.read_blob(x['sha256'])
+                for x in store.load_manifest(ref)['members'] if x['name'] in names}
+    try:
+        with ArchiveReader(ref) as reader:
+            return {x: reader.read(x) for x in names if x in reader.members}
+    except ValueError:
+        pass
+    # not indexed, scan (sequentially decompress) until all files are found
+    out = {}
+    with tarfile.open(ref, mode='r') as tar:
+        for info in tar:
+            name = info.name.split('/', 1)[-1]
+            if info.isfile() and name in names:
+                out[name] = tar.extractfile(info).read()
+                if len(out) == len(names):
+                    break
+    return out
+
+
+def load_info(cfg: ProgramConfig, kind, ref):
+    """Return (kind, ref, program_info.json raw) or None."""
+    try:
+        info_raw = read_members(cfg, kind, ref, ['program_info.json']).get('program_info.json')
+    except Exception as e:
+        print(f'skip "{ref}": {e!r}')
+        return None
+    if info_raw is None:
+        print(f'skip "{ref}": no program_info.json')
+        return None
+    return kind, ref, info_raw
+
+
+def rebuild_episode(cfg: ProgramConfig, kind, ref, info_raw: bytes, tags: bool) -> dict:
+    """Rewrite tags of published audio (if tags), return wikitext row and podcast episodes of the episode."""
+    dl = hibiki.Downloader()
+    info_json = json.loads(info_raw.decode('utf-8'))
+    date, episode = dl.get_date_episode(info_raw)
+    metadata = dl.get_metadata(info_raw)
+    audio = {}
+    for stream in handler_generic.VIDEO_KEYS:
+        filename = os.path.join(cfg.AUDIO_DIR, cfg.audio_name(episode, stream))
+        if os.access(filename, os.F_OK):
+            audio[stream] = filename
+
+    if tags and audio:
+        art_names = [
+            dl.filename_from_url(info_json['episode']['chapters'][0]['pc_image_url']),
+            dl.filename_from_url(info_json['episode']['episode_parts'][0]['pc_image_url']),
+        ]
+        images = read_members(cfg, kind, ref, art_names)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            arts = []
+            for name in art_names:
+                if name in images:
+                    arts.append(os.path.join(temp_dir, name))
+                    with open(arts[-1], 'wb') as f:
+                        f.write(images[name])
+            for stream, filename in audio.items():
+                renditions = [os.path.join(cfg.AUDIO_DIR, cfg.rendition_name(episode, stream, x['name']))
+                              for x in cfg.RENDITIONS]
+                for tagged in [filename] + [x for x in renditions if os.access(x, os.F_OK)]:
+                    mp4tools.write_tags(tagged, handler_generic.get_tags(cfg, metadata, date, episode, stream),
+                                        wipe=True)
+                    if len(arts) == len(art_names):
+                        mp4tools.write_arts(tagged, arts, wipe=True)
+                    else:
+                        print(f'warning: images of episode {episode} not archived, arts of "{tagged}" kept')
+                    mp4tools.optimize(tagged)
+
+    episodes = [handler_generic.get_podcast_episode(cfg, info_json, metadata, date, episode, stream, filename)
+                for stream, filename in audio.items()]
+    return {
+        'episode': episode,
+        'wikitext': handler_generic.gen_table(cfg, info_json),
+        'podcast_episodes': [x.to_dict() for x in episodes],
+        'audio': {stream: (filename, int(info_json['episode'][handler_generic.VIDEO_KEYS[stream]]['duration']),
+                           info_json['episode'][handler_generic.VIDEO_KEYS[stream]]['id'])
+                  for stream, filename in audio.items()},
+    }
+
+
+def insert_episode(episodes: typing.List[PodcastEpisode], episode: PodcastEpisode):
+    """Insert before the first episode published later (episodes are oldest first), append if unknown."""
+    if episode.pub_date is not None:
+        for i, x in enumerate(episodes):
+            if x.pub_date is not None and x.pub_date > episode.pub_date:
+                episodes.insert(i, episode)
+                return
+    episodes.append(episode)
+
+
+def rebuild(program_name, wikitext=True, podcast=True, tags=True, workers=None, wikitext_file=None):
+    with open('config.json', 'r', encoding='utf-8') as f:
+        program_config = json.load(f).get('program_config', {}).get(program_name, {})
+    handler = importlib.import_module(f'handler_{program_config.get("handler", program_name)}')
+    cfg = handler_generic.get_config(program_name, program_config, getattr(handler, 'DEFAULTS', None))
+
+    sources = list_sources(cfg)
+    print(f'{len(sources)} archives of {program_name}')
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        # latest program_info.json of each episode
+        latest = {}
+        kinds, refs = zip(*sources) if sources else ((), ())
+        for source in pool.map(load_info, [cfg] * len(sources), kinds, refs):
+            if source is None:
+                continue
+            try:
+                info_json = json.loads(source[2].decode('utf-8'))
+                date, episode = hibiki.Downloader().get_date_episode(source[2])
+                key = info_json['episode']['updated_at']
+            except Exception as e:
+                print(f'skip "{source[1]}": {e!r}')
+                continue
+            if episode not in latest or key >= latest[episode][0]:
+                latest[episode] = key, source
+        print(f'{len(latest)} episodes')
+
+        futures = [pool.submit(rebuild_episode, cfg, *latest[x][1], tags) for x in sorted(latest)]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f'rebuild failed: {e!r}')
+        print(f'{len(results)} episodes rebuilt')
+
+    if wikitext:
+        text = '\n'.join(x['wikitext'] for x in results)
+        if wikitext_file is None:
+            print(text)
+        else:
+            with open(wikitext_file, 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+            print(f'wikitext written to "{wikitext_file}"')
+
+    if tags and cfg.CATALOG_FILE is not None:
+        # sizes and hashes changed
+        with Catalog(cfg.CATALOG_FILE) as catalog:
+            for result in results:
+                for stream, (filename, duration, video_id) in result['audio'].items():
+                    catalog.add_audio(program_name, result['episode'], stream, filename, duration, video_id)
+
+    if podcast:
+        with open('save.json', 'r', encoding='utf-8') as f:
+            save_all = json.load(f)
+        save = save_all.setdefault(program_name, {}).setdefault('callback_save', {})
+        if save.get('podcast') is None:
+            pd = handler_generic.get_default_podcast(cfg)
+        else:
+            pd = Podcast.from_dict(save['podcast'])
+        # replace rebuilt episodes (by guid), keep episodes which were not rebuilt (no archive, failed, ...)
+        rebuilt = [PodcastEpisode.from_dict(x) for result in results for x in result['podcast_episodes']]
+        by_guid = {x.guid: x for x in rebuilt}
+        guids = {x.guid for x in pd.episodes}
+        pd.episodes = [by_guid.get(x.guid, x) for x in pd.episodes]
+        for x in rebuilt:
+            if x.guid not in guids:
+                insert_episode(pd.episodes, x)
+        handler_generic.write_podcast(cfg, pd, save)
+        save['podcast'] = pd.to_dict()
+        with open('save.json', 'w', encoding='utf-8') as f:
+            json.dump(save_all, f, ensure_ascii=False, indent=4)
+        updated = len(by_guid.keys() & guids)
+        print(f'podcast rebuilt: {updated} episodes updated, {len(by_guid) - updated} added, '
+              f'{len(pd.episodes)} in total')
+
+
+def main(argv):
+    args = list(argv)
+    if not args:
+        print(__doc__)
+        sys.exit(-1)
+    workers = None
+    wikitext_file = None
+    for option in ('-j', '-o'):
+        if option in args:
+            i = args.index(option)
+            value = args[i + 1]
+            del args[i:i + 2]
+            if option == '-j':
+                workers = int(value)
+            else:
+                wikitext_file = value
+    program_name, parts = args[0], set(args[1:])
+    unknown = parts - {'wikitext', 'podcast', 'tags'}
+    if unknown:
+        print(f'unknown: {", ".join(unknown)}')
+        print(__doc__)
+        sys.exit(-1)
+    parts = parts or {'wikitext', 'podcast', 'tags'}
+    rebuild(program_name, 'wikitext' in parts, 'podcast' in parts, 'tags' in parts, workers, wikitext_file)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,165 @@
+"""resource budgets shared by all pipelines of a process
+
+Work is labeled with a resource class and takes slots of its budget while running:
+  network  downloads (hibiki.Downloader.download, download_images)
+  cpu      compression and media processing (archive blocks, remux, mp4tools)
+Programs running side by side then share the limits, e.g. a few downloads keep the link busy
+while compression uses the cores, instead of all pipelines compressing (or downloading) at once.
+
+Slots are reentrant per thread: nested work of the same class held by one thread takes no more slots.
+Never wait for network work while holding cpu slots: a download holds its network slot while
+compression of its archive blocks waits for cpu slots (with several programs this would deadlock).
+Work waiting for slots shows up as "wait <resource>" spans in tracing.
+"""
+
+import contextlib
+import functools
+import os
+import threading
+import time
+import typing
+
+import tracing
+
+# default limits, slots per resource class (see configure)
+LIMITS = {
+    'network': 2,  # concurrent download stages (each with its own connections)
+    'cpu': os.cpu_count() or 1,
+}
+
+
+class Budget:
+    """Weighted semaphore with usage statistics."""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = max(int(limit), 1)
+        self.in_use = 0
+        self.peak = 0
+        self.waited = 0.0  # seconds, total
+        self._cond = threading.Condition()
+
+    def acquire(self, weight=1) -> int:
+        """Wait for slots, return the weight taken (capped at the limit, so large work still runs alone)."""
+        weight = min(max(weight, 1), self.limit)
+        with self._cond:
+            if self.in_use + weight <= self.limit:
+                self.in_use += weight
+                self.peak = max(self.peak, self.in_use)
+                return weight
+        start = time.perf_counter()
+        with tracing.span(f'wait {self.name}', 'scheduler', weight=weight):
+            with self._cond:
+                self._cond.wait_for(lambda: self.in_use + weight <= self.limit)
+                self.in_use += weight
+                self.peak = max(self.peak, self.in_use)
+                self.waited += time.perf_counter() - start
+        return weight
+
+    def release(self, weight):
+        with self._cond:
+            self.in_use -= weight
+            self._cond.notify_all()
+
+    def set_limit(self, limit):
+        with self._cond:
+            self.limit = max(int(limit), 1)
+            self._cond.notify_all()
+
+
+class Scheduler:
+    def __init__(self, limits: typing.Dict[str, int] = None):
+        self.budgets: typing.Dict[str, Budget] = {}
+        self._held = threading.local()
+        self.configure(limits or LIMITS)
+
+    def configure(self, limits: typing.Dict[str, int]):
+        for name, limit in limits.items():
+            if name in self.budgets:
+                self.budgets[name].set_limit(limit)
+            else:
+                self.budgets[name] = Budget(name, limit)
+
+    def _get_budget(self, resource) -> Budget:
+        try:
+            return self.budgets[resource]
+        except KeyError:
+            raise ValueError(f'Unknown resource class: {resource}') from None
+
+    def acquire(self, resource, weight=1) -> int:
+        """Take slots without a context (e.g. for the lifetime of an object), release with the returned weight."""
+        return self._get_budget(resource).acquire(weight)
+
+    def release(self, resource, weight):
+        self._get_budget(resource).release(weight)
+
+    def get_limit(self, resource) -> int:
+        return self._get_budget(resource).limit
+
+    @contextlib.contextmanager
+    def slot(self, resource, weight=1):
+        budget = self._get_budget(resource)
+        held = self._held.__dict__.setdefault('counts', {})
+        if held.get(resource):
+            held[resource] += 1
+            try:
+                yield
+            finally:
+                held[resource] -= 1
+            return
+        taken = budget.acquire(weight)
+        held[resource] = 1
+        try:
+            yield
+        finally:
+            held[resource] = 0
+            budget.release(taken)
+
+    def report(self):
+        print('resource budgets:')
+        for budget in self.budgets.values():
+            print(f'  {budget.name:<10} limit {budget.limit:3d}  peak {budget.peak:3d}  waited {budget.waited:8.2f}s')
+
+
+_scheduler = Scheduler()
+
+
+def get_scheduler() -> Scheduler:
+    return _scheduler
+
+
+def configure(limits: typing.Dict[str, int]):
+    """Change limits, e.g. from ["main_config"]["resources"]."""
+    _scheduler.configure(limits)
+
+
+def slot(resource, weight=1):
+    return _scheduler.slot(resource, weight)
+
+
+def resource(resource_name, weight=1):
+    """Decorator, run the function holding slots of resource_name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _scheduler.slot(resource_name, weight):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if __name__ == '__main__':
+    # 3 "downloads" and 6 "compressions" with 1 network and 2 cpu slots
+    import concurrent.futures
+
+    _s = Scheduler({'network': 1, 'cpu': 2})
+
+    def _work(_resource, _seconds):
+        with _s.slot(_resource):
+            time.sleep(_seconds)
+
+    _t = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(9) as _pool:
+        list(_pool.map(_work, ['network'] * 3 + ['cpu'] * 6, [0.2] * 9))
+    print(f'took {time.perf_counter() - _t:.2f}s (expected 0.6s)')
+    _s.report()
@@ -0,0 +1,312 @@
+"""static HTTP server for AUDIO_DIR and the podcast feed (optional, instead of a separate web server)
+
+Files are sent with os.sendfile (via loop.sendfile), with byte ranges, conditional requests
+(ETag / Last-Modified) and keep-alive. Feed files are served precompressed (.gz / .br sidecars)
+when the client accepts it, with ETags from PODCAST_MANIFEST_FILE.
+
+The layout is read from config.json: for each program, AUDIO_DIR is served at the path of
+AUDIO_URL_PREFIX and the feed files of PODCAST_FILE at the path of PODCAST_URL_PREFIX
+(default AUDIO_URL_PREFIX). Listen address is ["main_config"]["server"] {"host", "port"}.
+
+usage: python static_server.py [config.json]
+"""
+
+import asyncio
+import email.utils
+import importlib
+import json
+import mimetypes
+import os
+import re
+import sys
+import typing
+import urllib.parse
+from dataclasses import dataclass
+
+import handler_generic
+
+HEADER_LIMIT = 16 * 1024
+IDLE_TIMEOUT = 30
+CONTENT_TYPES = {
+    '.m4a': 'audio/mp4',
+    '.rss': 'application/rss+xml; charset=utf-8',
+    '.json': 'application/json',
+}
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+@dataclass
+class Route:
+    prefix: str  # url path, e.g. /shuwarin-radio/
+    directory: str
+    pattern: typing.Optional[str] = None  # regex for file names served by this route, None for all
+    manifest_file: typing.Optional[str] = None  # podcast.FeedWriter manifest, enables precompressed files
+
+    def match(self, path) -> typing.Optional[str]:
+        """Return the file name of path, or None if not served by this route."""
+        if not path.startswith(self.prefix):
+            return None
+        name = path[len(self.prefix):]
+        if not name or name.startswith('/') or any(x in ('', '.', '..') for x in name.split('/')):
+            return None
+        if self.pattern is not None and re.fullmatch(self.pattern, name) is None:
+            return None
+        return name
+
+
+def routes_from_config(config: dict) -> typing.List[Route]:
+    """Routes for all programs, settings not in config are the defaults of the handler."""
+    routes = []
+    for program_name in config['programs']:
+        program_config = config.get('program_config', {}).get(program_name, {})
+        handler = importlib.import_module(f'handler_{program_config.get("handler", program_name)}')
+        cfg = handler_generic.get_config(program_name, program_config, getattr(handler, 'DEFAULTS', None))
+
+        stem, ext = os.path.splitext(os.path.basename(cfg.PODCAST_FILE))
+        routes.append(Route(
+            prefix=urllib.parse.urlsplit(cfg.PODCAST_URL_PREFIX or cfg.AUDIO_URL_PREFIX).path,
+            directory=os.path.dirname(cfg.PODCAST_FILE) or '.',
+            pattern=rf'{re.escape(stem)}(-\d{{4}})?{re.escape(ext)}',
+            manifest_file=cfg.PODCAST_MANIFEST_FILE,
+        ))
+        routes.append(Route(urllib.parse.urlsplit(cfg.AUDIO_URL_PREFIX).path, cfg.AUDIO_DIR))
+    return routes
+
+
+class HTTPError(Exception):
+    def __init__(self, status, reason):
+        super().__init__(f'{status} {reason}')
+        self.status = status
+        self.reason = reason
+
+
+def parse_range(value, size) -> typing.Optional[typing.Tuple[int, int]]:
+    """Parse a single "bytes=" range, return (start, end) (end exclusive). None to send the full file.
+
+    Raise HTTPError 416 for an unsatisfiable range.
+    """
+    m = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', value)
+    if m is None or (not m.group(1) and not m.group(2)):
+        return None  # malformed or multiple ranges, ignored
+    if not m.group(1):
+        length = int(m.group(2))
+        if length == 0:
+            raise HTTPError(416, 'Range Not Satisfiable')
+        return max(size - length, 0), size
+    start = int(m.group(1))
+    end = int(m.group(2)) + 1 if m.group(2) else size
+    if start >= size or end <= start:
+        raise HTTPError(416, 'Range Not Satisfiable')
+    return start, min(end, size)
+
+
+def _etag_matches(header, etag):
+    if header.strip() == '*':
+        return True
+    tags = [x.strip() for x in header.split(',')]
+    return etag in tags or f'W/{etag}' in tags
+
+
+class StaticServer:
+    def __init__(self, routes: typing.List[Route], host='127.0.0.1', port=8080):
+        self.routes = routes
+        self.host = host
+        self.port = port
+        self._manifests: typing.Dict[str, typing.Tuple[int, dict]] = {}
+
+    def _load_manifest(self, filename) -> dict:
+        """Manifest content, reloaded when changed."""
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        cached = self._manifests.get(filename)
+        if cached is None or cached[0] != mtime:
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    cached = mtime, json.load(f)
+            except ValueError:
+                cached = mtime, {}
+            self._manifests[filename] = cached
+        return cached[1]
+
+    def resolve(self, path, accept_encoding='') -> typing.Tuple[str, typing.Optional[str], typing.Optional[str]]:
+        """Return (filename, content encoding, etag from manifest) of url path."""
+        for route in self.routes:
+            name = route.match(path)
+            if name is None:
+                continue
+            filename = os.path.join(route.directory, *name.split('/'))
+            if not os.path.isfile(filename):
+                continue
+            if route.manifest_file is None:
+                return filename, None, None
+            entry = self._load_manifest(route.manifest_file).get(name, {})
+            accepted = [x.split(';')[0].strip() for x in accept_encoding.split(',')]
+            for encoding, ext in ENCODINGS:
+                info = entry.get('encodings', {}).get(encoding)
+                if encoding in accepted and info is not None and os.path.isfile(filename + ext):
+                    return filename + ext, encoding, info['etag']
+            return filename, None, entry.get('etag')
+        raise HTTPError(404, 'Not Found')
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._send_error(writer, HTTPError(431, 'Request Header Fields Too Large'))
+                    break
+                keep_alive = await self._handle_request(head.decode('latin1'), writer)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _send_error(self, writer, e: HTTPError, extra=None):
+        body = f'{e.status} {e.reason}\n'.encode('utf-8')
+        headers = {'Content-Type': 'text/plain', 'Content-Length': str(len(body))}
+        headers.update(extra or {})
+        self._write_head(writer, e.status, e.reason, headers)
+        writer.write(body)
+        await writer.drain()
+
+    @staticmethod
+    def _write_head(writer, status, reason, headers: dict):
+        lines = [f'HTTP/1.1 {status} {reason}', f'Date: {email.utils.formatdate(usegmt=True)}']
+        lines.extend(f'{k}: {v}' for k, v in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1'))
+
+    async def _handle_request(self, head: str, writer: asyncio.StreamWriter) -> bool:
+        """Handle one request, return whether the connection is kept alive."""
+        lines = head.split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            await self._send_error(writer, HTTPError(400, 'Bad Request'), {'Connection': 'close'})
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        conn_headers = {'Connection': 'keep-alive' if keep_alive else 'close'}
+
+        try:
+            if method not in ('GET', 'HEAD'):
+                raise HTTPError(405, 'Method Not Allowed')
+            path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+            filename, encoding, etag = self.resolve(path, headers.get('accept-encoding', ''))
+            f = open(filename, 'rb')
+        except HTTPError as e:
+            extra = dict(conn_headers)
+            if e.status == 405:
+                extra['Allow'] = 'GET, HEAD'
+            await self._send_error(writer, e, extra)
+            return keep_alive
+
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            if etag is None:
+                etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+            last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+            # type of the uncompressed file
+            ext = os.path.splitext(filename[:-len(dict(ENCODINGS)[encoding])] if encoding else filename)[1]
+            resp_headers = {
+                'Content-Type': CONTENT_TYPES.get(ext) or mimetypes.guess_type(filename)[0]
+                or 'application/octet-stream',
+                'ETag': etag,
+                'Last-Modified': last_modified,
+                'Accept-Ranges': 'bytes',
+            }
+            if encoding is not None:
+                resp_headers['Content-Encoding'] = encoding
+            if any(r.manifest_file is not None and r.match(path) for r in self.routes):
+                resp_headers['Vary'] = 'Accept-Encoding'
+            resp_headers.update(conn_headers)
+
+            if self._not_modified(headers, etag, st.st_mtime):
+                for k in ('Content-Type', 'Accept-Ranges', 'Content-Encoding'):
+                    resp_headers.pop(k, None)
+                self._write_head(writer, 304, 'Not Modified', resp_headers)
+                await writer.drain()
+                return keep_alive
+
+            start, end = 0, size
+            status, reason = 200, 'OK'
+            if 'range' in headers and self._if_range(headers, etag, st.st_mtime):
+                try:
+                    r = parse_range(headers['range'], size)
+                except HTTPError as e:
+                    await self._send_error(writer, e, {'Content-Range': f'bytes */{size}', **conn_headers})
+                    return keep_alive
+                if r is not None:
+                    start, end = r
+                    status, reason = 206, 'Partial Content'
+                    resp_headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+            resp_headers['Content-Length'] = str(end - start)
+            self._write_head(writer, status, reason, resp_headers)
+            await writer.drain()
+            if method == 'GET' and end > start:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, start, end - start)
+        return keep_alive
+
+    @staticmethod
+    def _not_modified(headers, etag, mtime):
+        if 'if-none-match' in headers:
+            return _etag_matches(headers['if-none-match'], etag)
+        if 'if-modified-since' in headers:
+            try:
+                since = email.utils.parsedate_to_datetime(headers['if-modified-since']).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    @staticmethod
+    def _if_range(headers, etag, mtime):
+        value = headers.get('if-range')
+        if value is None:
+            return True
+        if value.startswith('"') or value.startswith('W/'):
+            return value == etag
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    async def start(self) -> asyncio.AbstractServer:
+        server = await asyncio.start_server(self.handle, self.host, self.port, limit=HEADER_LIMIT)
+        self.port = server.sockets[0].getsockname()[1]
+        return server
+
+    async def serve_forever(self):
+        server = await self.start()
+        for route in self.routes:
+            print(f'serving "{route.directory}" at http://{self.host}:{self.port}{route.prefix}')
+        async with server:
+            await server.serve_forever()
+
+
+def main(config_file='config.json'):
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    server_config = config['main_config'].get('server', {})
+    server = StaticServer(routes_from_config(config),
+                          server_config.get('host', '127.0.0.1'), server_config.get('port', 8080))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
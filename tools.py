@@ -1,4 +1,9 @@
+import concurrent.futures
+import errno
 import os
+import shutil
+import threading
+import typing
 
 
 def find_valid_filename(filename: str, ext=None):
@@ -20,6 +25,163 @@ def find_valid_filename(filename: str, ext=None):
     return filename + add + ext
 
 
+def reserve_filename(filename, ext=None) -> str:
+    """Create an empty file at the next free name of find_valid_filename, return the name.
+
+    Publish to it later with publish_file (replacing it), or remove it.
+    """
+    while True:
+        name = find_valid_filename(filename, ext)
+        try:
+            os.close(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            continue
+        return name
+
+
 def rename_file(filename, ext=None):
-    new_filename = find_valid_filename(filename, ext)
-    os.rename(filename, new_filename)
+    publish_file(filename, filename, ext, unique=True)
+
+
+FICLONE = 0x40049409  # ioctl, reflink a whole file (btrfs, xfs, ...)
+
+
+def clone_file(src, dst):
+    """Make dst a hard link (or reflink, or copy) of src. dst must not exist."""
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+
+
+def copy_file_kernel(src, dst):
+    """Copy src to the new file dst without passing the data through Python, and fsync dst.
+
+    Reflink if the filesystem can, else copy_file_range, else sendfile.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        shutil.copymode(src, dst)
+        try:
+            import fcntl
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except (ImportError, OSError):
+            size = os.fstat(fsrc.fileno()).st_size
+            copy_range = getattr(os, 'copy_file_range', None)
+            offset = 0
+            while offset < size:
+                count = min(size - offset, 1 << 30)
+                if copy_range is not None:
+                    try:
+                        n = copy_range(fsrc.fileno(), fdst.fileno(), count)  # advances both file positions
+                    except OSError as e:
+                        # e.g. older kernels across filesystems
+                        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                            raise
+                        copy_range = None
+                        continue
+                else:
+                    n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, count)
+                if n == 0:
+                    raise OSError(f'"{src}" shrank while copying')
+                offset += n
+        os.fsync(fdst.fileno())
+
+
+def _fsync_dir(dirname):
+    try:
+        fd = os.open(dirname or '.', os.O_RDONLY)
+    except OSError:
+        return  # e.g. Windows
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _place(src, dst, ext, unique) -> str:
+    """Rename src to dst on the same filesystem (OSError EXDEV otherwise), return the name."""
+    if not unique:
+        os.replace(src, dst)
+        return dst
+    while True:
+        name = find_valid_filename(dst, ext)
+        try:
+            os.link(src, name)  # fails if another publish took the name meanwhile
+        except FileExistsError:
+            continue
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                raise
+            os.rename(src, name)  # directory, or no hard links on this filesystem
+            return name
+        os.remove(src)
+        return name
+
+
+def publish_file(src, dst, ext=None, unique=False) -> str:
+    """Move file src to dst, also to another filesystem, return the published name.
+
+    A rename if possible. Across filesystems, src is copied in the kernel (copy_file_range) next to dst,
+    synced and renamed to dst, so dst never appears incomplete; then src is removed.
+    unique: keep an existing dst and use the next free name of find_valid_filename(dst, ext) instead.
+    """
+    try:
+        return _place(src, dst, ext, unique)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temp_filename = os.path.join(os.path.dirname(dst),
+                                 f'.{os.path.basename(dst)}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        copy_file_kernel(src, temp_filename)
+        name = _place(temp_filename, dst, ext, unique)
+    except BaseException:
+        if os.access(temp_filename, os.F_OK):
+            os.remove(temp_filename)
+        raise
+    _fsync_dir(os.path.dirname(name))
+    os.remove(src)
+    return name
+
+
+class ParallelError(Exception):
+    """Items of parallel_map failed, errors: {item: exception}."""
+
+    def __init__(self, errors: dict):
+        self.errors = errors
+        super().__init__('; '.join(f'{item}: {e!r}' for item, e in errors.items()))
+
+
+def parallel_map(func, items: typing.Iterable, max_workers=None) -> dict:
+    """Return {item: func(item)}, on at most max_workers (default cpu count) threads.
+
+    All items run even if some fail, then ParallelError is raised with the errors of each failed item.
+    """
+    items = list(items)
+    if not items:
+        return {}
+    max_workers = min(max_workers or os.cpu_count() or 1, len(items))
+    results = {}
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='Parallel') as pool:
+        futures = {item: pool.submit(func, item) for item in items}
+        for item, future in futures.items():
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                print(f'{item} failed: {e!r}')
+                errors[item] = e
+    if errors:
+        raise ParallelError(errors)
+    return results
@@ -0,0 +1,122 @@
+"""lightweight span tracing
+
+    with tracing.span('remux', episode=12):
+        ...
+
+Spans are only recorded after start(), otherwise span() returns a shared no-op context manager.
+Recorded spans can be exported as Chrome trace-event JSON (open in https://ui.perfetto.dev or
+chrome://tracing) and summarized as a table of count / total / mean / max time per span name.
+Spans of child processes are not collected.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import typing
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class Tracer:
+    def __init__(self):
+        self.events: typing.List[dict] = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def span(self, name, cat='', **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': (start - self._start) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': self._pid,
+                'tid': threading.get_ident(),
+            }
+            if args:
+                event['args'] = {k: str(v) for k, v in args.items()}
+            with self._lock:
+                self.events.append(event)
+
+    def export_chrome(self, filename):
+        with self._lock:
+            events = list(self.events)
+        threads = {}
+        for thread in threading.enumerate():
+            threads[thread.ident] = thread.name
+        # name the threads in the viewer
+        for tid in {x['tid'] for x in events}:
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                           'args': {'name': threads.get(tid, str(tid))}})
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+
+    def summary(self) -> typing.List[dict]:
+        """Per span name: count, total, mean and max seconds, sorted by total."""
+        stats = {}
+        with self._lock:
+            for event in self.events:
+                s = stats.setdefault(event['name'], {'name': event['name'], 'count': 0, 'total': 0.0, 'max': 0.0})
+                s['count'] += 1
+                s['total'] += event['dur'] / 1e6
+                s['max'] = max(s['max'], event['dur'] / 1e6)
+        for s in stats.values():
+            s['mean'] = s['total'] / s['count']
+        return sorted(stats.values(), key=lambda x: -x['total'])
+
+    def print_summary(self):
+        print(f'{"span":<28} {"count":>7} {"total":>10} {"mean":>10} {"max":>10}')
+        for s in self.summary():
+            print(f'{s["name"]:<28} {s["count"]:>7} {s["total"]:>9.2f}s {s["mean"]:>9.3f}s {s["max"]:>9.3f}s')
+
+
+_tracer: typing.Optional[Tracer] = None
+
+
+def start() -> Tracer:
+    """Start recording spans (again, previous spans are dropped)."""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop() -> typing.Optional[Tracer]:
+    """Stop recording, return the tracer with recorded spans."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def enabled():
+    return _tracer is not None
+
+
+def span(name, cat='', **args):
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, cat, **args)
+
+
+def traced(name=None, cat=''):
+    """Decorator, record each call as a span."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            with _tracer.span(span_name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
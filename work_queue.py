@@ -0,0 +1,357 @@
+"""work queue with leased jobs, for several workers (processes or hosts) sharing episode pipelines and backfills
+
+A job is identified by (program, episode); adding it again is a no-op.
+A worker acquires a job with a lease, extends it with heartbeats while working, and completes it.
+Leases not extended in time expire, the job is queued again (after a crashed or stuck worker).
+Completion is recorded once per job; completing an already completed job (e.g. by a worker
+whose lease expired) is ignored, so results are idempotent.
+
+SQLiteWorkQueue keeps everything in one SQLite file (WAL mode, works for processes of one host
+or a shared filesystem with working locks). open_queue() is the place to plug in a network store
+with the same methods.
+
+usage:
+  python work_queue.py <queue.db> add <program> <episode> [payload json]
+  python work_queue.py <queue.db> stats
+  python work_queue.py <queue.db> list
+  python work_queue.py <queue.db> requeue
+  python work_queue.py test
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import typing
+import uuid
+from dataclasses import dataclass
+
+LEASE_SECONDS = 300
+HEARTBEAT_SECONDS = 60
+MAX_ATTEMPTS = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    program TEXT NOT NULL,
+    episode INTEGER NOT NULL,
+    payload TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',  -- queued, leased, done, failed
+    worker TEXT,
+    lease_token TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL,
+    PRIMARY KEY (program, episode)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until);
+CREATE TABLE IF NOT EXISTS completions (
+    program TEXT NOT NULL,
+    episode INTEGER NOT NULL,
+    worker TEXT,
+    result TEXT,
+    completed REAL,
+    PRIMARY KEY (program, episode)
+);
+'''
+
+
+@dataclass
+class Job:
+    program: str
+    episode: int
+    payload: typing.Any
+    worker: str
+    lease_token: str
+    lease_until: float
+    attempts: int
+
+
+class LeaseLost(Exception):
+    """The lease of the job expired and it was given to another worker."""
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+class SQLiteWorkQueue:
+    def __init__(self, filename, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.filename = filename
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()  # connection shared by worker and heartbeat thread
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _transaction(self, func):
+        # BEGIN IMMEDIATE takes the write lock first, read-check-update is atomic between processes
+        with self._lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func()
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def add(self, program, episode, payload=None) -> bool:
+        """Queue a job, return False if it already exists (queued, running or done)."""
+        with self._lock:
+            cur = self.db.execute(
+                'INSERT OR IGNORE INTO jobs (program, episode, payload, created) VALUES (?, ?, ?, ?)',
+                (program, episode, json.dumps(payload, ensure_ascii=False), time.time()))
+            return cur.rowcount > 0
+
+    def _requeue_expired(self, now):
+        self.db.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "error = 'lease expired', worker = NULL, lease_token = NULL, lease_until = NULL "
+            "WHERE state = 'leased' AND lease_until < ?",
+            (self.max_attempts, now))
+
+    def requeue_expired(self):
+        self._transaction(lambda: self._requeue_expired(time.time()))
+
+    def acquire(self, worker=None, program=None) -> typing.Optional[Job]:
+        """Lease the oldest queued job (of program), or return None."""
+        worker = worker or default_worker_id()
+
+        def acquire_job():
+            now = time.time()
+            self._requeue_expired(now)
+            if program is None:
+                row = self.db.execute(
+                    "SELECT program, episode, payload, attempts FROM jobs WHERE state = 'queued' "
+                    "ORDER BY created, episode LIMIT 1").fetchone()
+            else:
+                row = self.db.execute(
+                    "SELECT program, episode, payload, attempts FROM jobs WHERE state = 'queued' AND program = ? "
+                    "ORDER BY created, episode LIMIT 1", (program,)).fetchone()
+            if row is None:
+                return None
+            token = uuid.uuid4().hex
+            lease_until = now + self.lease_seconds
+            self.db.execute(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_token = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE program = ? AND episode = ?",
+                (worker, token, lease_until, row[0], row[1]))
+            return Job(row[0], row[1], json.loads(row[2]), worker, token, lease_until, row[3] + 1)
+
+        return self._transaction(acquire_job)
+
+    def heartbeat(self, job: Job):
+        """Extend the lease, raise LeaseLost if the job is not ours any more."""
+        lease_until = time.time() + self.lease_seconds
+        with self._lock:
+            cur = self.db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE program = ? AND episode = ? "
+                "AND state = 'leased' AND lease_token = ?",
+                (lease_until, job.program, job.episode, job.lease_token))
+        if cur.rowcount == 0:
+            raise LeaseLost(f'lease of {job.program} {job.episode} lost')
+        job.lease_until = lease_until
+
+    def complete(self, job: Job, result=None) -> bool:
+        """Record completion, return False (result ignored) if the lease was lost or the job already completed."""
+        def complete_job():
+            cur = self.db.execute(
+                "UPDATE jobs SET state = 'done', lease_token = NULL, lease_until = NULL, error = NULL "
+                "WHERE program = ? AND episode = ? AND state = 'leased' AND lease_token = ?",
+                (job.program, job.episode, job.lease_token))
+            if cur.rowcount == 0:
+                return False
+            cur = self.db.execute(
+                'INSERT OR IGNORE INTO completions (program, episode, worker, result, completed) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (job.program, job.episode, job.worker, json.dumps(result, ensure_ascii=False), time.time()))
+            return cur.rowcount > 0
+
+        return self._transaction(complete_job)
+
+    def fail(self, job: Job, error):
+        """Give the job back (queued again until max_attempts, then failed)."""
+        with self._lock:
+            self.db.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "error = ?, worker = NULL, lease_token = NULL, lease_until = NULL "
+                "WHERE program = ? AND episode = ? AND lease_token = ?",
+                (self.max_attempts, str(error), job.program, job.episode, job.lease_token))
+
+    def get_result(self, program, episode):
+        row = self.db.execute('SELECT result FROM completions WHERE program = ? AND episode = ?',
+                              (program, episode)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self._lock:
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def list(self) -> typing.List[dict]:
+        with self._lock:
+            cur = self.db.execute(
+                'SELECT program, episode, state, worker, lease_until, attempts, error FROM jobs '
+                'ORDER BY program, episode')
+            return [dict(zip((x[0] for x in cur.description), row)) for row in cur]
+
+
+def open_queue(url, **kwargs) -> SQLiteWorkQueue:
+    """Open a work queue, "sqlite:///path/queue.db" or a file name."""
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    elif '://' in url:
+        raise ValueError(f'Unsupported work queue: {url}')
+    return SQLiteWorkQueue(url, **kwargs)
+
+
+def run_worker(queue: SQLiteWorkQueue, func: typing.Callable[[Job], typing.Any], worker=None, program=None,
+               heartbeat_seconds=HEARTBEAT_SECONDS, idle_exit=True, poll_seconds=10):
+    """Run jobs with func(job) -> json serializable result, heartbeats are sent in background.
+
+    With idle_exit, return when no job is queued, otherwise poll for new jobs.
+    """
+    worker = worker or default_worker_id()
+    while True:
+        job = queue.acquire(worker, program)
+        if job is None:
+            if idle_exit:
+                return
+            time.sleep(poll_seconds)
+            continue
+        print(f'[{worker}] job {job.program} {job.episode} (attempt {job.attempts})')
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(heartbeat_seconds):
+                try:
+                    queue.heartbeat(job)
+                except LeaseLost:
+                    print(f'[{worker}] lease of {job.program} {job.episode} lost')
+                    lost.set()
+                    return
+                except sqlite3.Error as e:
+                    # e.g. database locked for too long, retry until the lease expires
+                    print(f'[{worker}] heartbeat of {job.program} {job.episode} failed: {e!r}')
+                    if time.time() >= job.lease_until:
+                        print(f'[{worker}] lease of {job.program} {job.episode} expired')
+                        lost.set()
+                        return
+
+        thread = threading.Thread(target=heartbeat, name=f'heartbeat {job.program} {job.episode}', daemon=True)
+        thread.start()
+        try:
+            result = func(job)
+        except Exception as e:
+            print(f'[{worker}] job {job.program} {job.episode} failed: {e!r}')
+            queue.fail(job, repr(e))
+            continue
+        finally:
+            stop.set()
+            thread.join()
+        if lost.is_set():
+            print(f'[{worker}] job {job.program} {job.episode} finished after its lease was lost, not completed')
+        elif not queue.complete(job, result):
+            print(f'[{worker}] job {job.program} {job.episode} was already completed or its lease lost')
+
+
+def _test_worker(filename, worker, crash_episode, log_file):
+    """Worker process of test(): crashes (exits without completing) on the first attempt of crash_episode."""
+    queue = SQLiteWorkQueue(filename, lease_seconds=1)
+
+    def work(job: Job):
+        with open(log_file, 'a', encoding='utf-8') as f:
+            f.write(f'{job.episode} {worker} start {time.time()}\n')
+        if job.episode == crash_episode and job.attempts == 1:
+            os._exit(1)
+        time.sleep(0.2)
+        with open(log_file, 'a', encoding='utf-8') as f:
+            f.write(f'{job.episode} {worker} end {time.time()}\n')
+        return {'worker': worker}
+
+    deadline = time.time() + 30
+    while time.time() < deadline and queue.stats().get('queued', 0) + queue.stats().get('leased', 0):
+        run_worker(queue, work, worker, heartbeat_seconds=0.3)
+        time.sleep(0.2)  # wait for expiring leases
+
+
+def test(workers=4, jobs=20):
+    import multiprocessing
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'queue.db')
+        log_file = os.path.join(temp_dir, 'log.txt')
+        with SQLiteWorkQueue(filename) as queue:
+            for i in range(jobs):
+                assert queue.add('test', i, {'i': i})
+            assert not queue.add('test', 0)
+        processes = [multiprocessing.Process(target=_test_worker, args=(filename, f'w{i}', 3, log_file))
+                     for i in range(workers)]
+        t = time.perf_counter()
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        print(f'{jobs} jobs on {workers} workers: {time.perf_counter() - t:.2f}s')
+
+        with SQLiteWorkQueue(filename) as queue:
+            stats = queue.stats()
+            print(stats)
+            assert stats == {'done': jobs}, stats
+            assert all(queue.get_result('test', i) is not None for i in range(jobs))
+        # no episode ran on two workers at the same time
+        runs = {}
+        with open(log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                episode, worker, event, ts = line.split()
+                runs.setdefault((int(episode), worker), {})[event] = float(ts)
+        for episode in range(jobs):
+            intervals = sorted((x['start'], x.get('end', x['start'])) for (e, w), x in runs.items() if e == episode)
+            for a, b in zip(intervals, intervals[1:]):
+                assert a[1] <= b[0], (episode, intervals)
+        # the worker which took episode 3 first crashed, another one completed it after the lease expired
+        crashed = [w for (e, w), x in runs.items() if e == 3 and 'end' not in x]
+        finished = [w for (e, w), x in runs.items() if e == 3 and 'end' in x]
+        assert len(crashed) == 1 and len(finished) == 1 and crashed != finished, runs
+        print('ok')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'test':
+        test()
+        sys.exit(0)
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(-1)
+    with open_queue(sys.argv[1]) as _queue:
+        _command = sys.argv[2]
+        if _command == 'add':
+            _payload = json.loads(sys.argv[5]) if len(sys.argv) > 5 else None
+            print('added' if _queue.add(sys.argv[3], int(sys.argv[4]), _payload) else 'exists')
+        elif _command == 'stats':
+            print(_queue.stats())
+        elif _command == 'list':
+            for _job in _queue.list():
+                print(f'{_job["program"]} {_job["episode"]:4d} {_job["state"]:<7} {_job["attempts"]} '
+                      f'{_job["worker"] or ""} {_job["error"] or ""}')
+        elif _command == 'requeue':
+            _queue.requeue_expired()
+            print(_queue.stats())
+        else:
+            print(__doc__)
+            sys.exit(-1)
@@ -3,8 +3,17 @@
 """wxpush wrapper
 
 doc: https://wxpusher.zjiecode.com/
+
+Notifications are sent by a background dispatcher: sendNotification only queues the message,
+messages sent inside a batch() block (e.g. one program run) are sent as one push when the block exits,
+failed pushes are retried with backoff, and queued messages are flushed (at most FLUSH_TIMEOUT) at exit.
+Once a flush is waiting, retries and backoff stop at its deadline.
 """
 
+import atexit
+import contextlib
+import queue
+import threading
 import time
 import traceback
 import base64
@@ -17,9 +26,17 @@ import requests
 # don't edit this manually, rewritten with data from config.json
 WxPusher_TOKEN = 'YOUR_TOKEN'
 WxPusher_UIDs = ['YOUR_UID']
+WxPusher_URL = 'https://wxpusher.zjiecode.com/api/send/message'
 
+TIMEOUT = 5
+RETRIES = 4
+BACKOFF = 2  # seconds, doubled after each failure
+FLUSH_TIMEOUT = 20  # max seconds to wait for pending messages at exit
+SEPARATOR = '\n' + '=' * 20 + '\n'
 
-def sendNotification(content, summary=None, contentType=1):
+
+def post_message(session: requests.Session, content, summary=None, contentType=1, timeout=TIMEOUT):
+    """Send one message synchronously, raise on failure."""
     payload = {
         "appToken": WxPusher_TOKEN,
         "content": content,
@@ -31,8 +48,196 @@ def sendNotification(content, summary=None, contentType=1):
         "uids": WxPusher_UIDs,
         # "url": "http:#wxpusher.zjiecode.com"  # 原文链接，可选参数
     }
-    r = requests.post('https://wxpusher.zjiecode.com/api/send/message', json=payload, timeout=5)
-    # print(r.json())
+    r = session.post(WxPusher_URL, json=payload, timeout=timeout)
+    r.raise_for_status()
+    result = r.json()
+    if result.get('code') != 1000:
+        raise RuntimeError(f'wxpush error {result.get("code")}: {result.get("msg")}')
+    return result
+
+
+class Dispatcher:
+    def __init__(self):
+        self.session = requests.Session()  # keep-alive connection for retries and later messages
+        self._queue = queue.Queue()  # lists of (content, summary, contentType), one push per content type
+        self._pending = 0  # queued or sending
+        self._lock = threading.Condition()
+        self._deadline = None  # of the last flush, retries stop there
+        self._thread = threading.Thread(target=self._run, name='wxpush', daemon=True)
+        self._thread.start()
+
+    def send(self, messages):
+        with self._lock:
+            self._pending += 1
+        self._queue.put(messages)
+
+    def flush(self, timeout=FLUSH_TIMEOUT) -> bool:
+        """Wait until queued messages are sent (or failed). Return False on timeout."""
+        with self._lock:
+            self._deadline = deadline = time.monotonic() + timeout
+            self._lock.notify_all()  # cut a backoff sleep short
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f'warning: {self._pending} notification(s) not sent')
+                    return False
+                self._lock.wait(remaining)
+        return True
+
+    def _time_left(self, end=None):
+        """Seconds until end (None: no limit), or until the flush deadline if that is earlier."""
+        now = time.monotonic()
+        ends = [x for x in (end, self._deadline) if x is not None]
+        return min(ends) - now if ends else float('inf')
+
+    def _sleep(self, seconds):
+        end = time.monotonic() + seconds
+        with self._lock:
+            while True:
+                remaining = self._time_left(end)
+                if remaining <= 0:
+                    return
+                self._lock.wait(remaining)
+
+    def _run(self):
+        while True:
+            messages = self._queue.get()
+            # coalesce messages of the same content type
+            groups = {}
+            for content, summary, content_type in messages:
+                groups.setdefault(content_type, []).append((content, summary))
+            for content_type, group in groups.items():
+                content = SEPARATOR.join(x[0] for x in group)
+                summaries = list(dict.fromkeys(x[1] for x in group if x[1]))
+                summary = ' / '.join(summaries) if summaries else None
+                self._send_with_retry(content, summary, content_type)
+            with self._lock:
+                self._pending -= 1
+                self._lock.notify_all()
+
+    def _send_with_retry(self, content, summary, content_type):
+        delay = BACKOFF
+        for i in range(RETRIES):
+            remaining = self._time_left()
+            if remaining <= 0:
+                break
+            try:
+                post_message(self.session, content, summary, content_type, timeout=min(TIMEOUT, remaining))
+                return True
+            except Exception as e:
+                print(f'wxpush failed ({i + 1}/{RETRIES}): {e!r}')
+                if i + 1 < RETRIES:
+                    self._sleep(delay)
+                    delay *= 2
+        print(f'wxpush gave up, message:\n{content}')
+        return False
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_dispatcher() -> Dispatcher:
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher()
+            atexit.register(_dispatcher.flush)
+        return _dispatcher
+
+
+@contextlib.contextmanager
+def batch():
+    """Collect messages sent by this thread inside the block, queue them as one push when it exits."""
+    if getattr(_local, 'batch', None) is not None:
+        yield  # nested, part of the outer batch
+        return
+    _local.batch = messages = []
+    try:
+        yield
+    finally:
+        _local.batch = None
+        if messages:
+            get_dispatcher().send(messages)
+
+
+def sendNotification(content, summary=None, contentType=1):
+    """Queue a message, it is sent in background (with the thread's batch, if any)."""
+    messages = getattr(_local, 'batch', None)
+    if messages is not None:
+        messages.append((content, summary, contentType))
+    else:
+        get_dispatcher().send([(content, summary, contentType)])
+
+
+def flush(timeout=FLUSH_TIMEOUT) -> bool:
+    if _dispatcher is None:
+        return True
+    return _dispatcher.flush(timeout)
+
+
+def test():
+    """Send through the dispatcher to a local stand-in endpoint.
+
+    The stand-in fails the first request, then succeeds; in the second part it always fails
+    and flush must return by its deadline despite the long backoff."""
+    import http.server
+    import json
+
+    global WxPusher_URL, BACKOFF
+    received = []
+    always_fail = threading.Event()
+
+    class StandIn(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            received.append(payload)
+            if len(received) == 1 or always_fail.is_set():
+                self.send_error(503)
+                return
+            body = json.dumps({'code': 1000, 'msg': 'ok'}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    WxPusher_URL = f'http://127.0.0.1:{server.server_port}/api/send/message'
+    BACKOFF = 0.1
+
+    t = time.perf_counter()
+    with batch():
+        sendNotification('message 1', summary='summary')
+        sendNotification('message 2', summary='summary')
+    # another run, pushed on its own
+    with batch():
+        sendNotification('message 3')
+    print(f'queued in {time.perf_counter() - t:.3f}s')
+    assert flush(10)
+    assert len(received) == 3, received  # failed + retried, both messages of the batch in one push
+    assert received[1]['content'] == 'message 1' + SEPARATOR + 'message 2', received[1]
+    assert received[1]['summary'] == 'summary'
+    assert received[2]['content'] == 'message 3', received[2]
+    print(f'ok, sent in {time.perf_counter() - t:.3f}s')
+
+    always_fail.set()
+    BACKOFF = 30
+    sendNotification('message 4')
+    time.sleep(0.5)  # first attempt failed, in backoff
+    t = time.perf_counter()
+    flush(1)  # False, or True if the dispatcher gave up just before
+    elapsed = time.perf_counter() - t
+    assert elapsed < 1.5, elapsed
+    time.sleep(0.2)
+    assert not _dispatcher._pending  # gave up at the deadline
+    server.shutdown()
+    print(f'ok, flush returned in {elapsed:.3f}s')
 
 
 if __name__ == '__main__':
@@ -40,8 +245,13 @@ if __name__ == '__main__':
 
     if len(sys.argv) <= 1:
         print(f'usage: {sys.argv[0]} [-b64] data')
+        print(f'       {sys.argv[0]} -test')
         sys.exit(-1)
     msg = sys.argv[1]
+    if msg == '-test':
+        test()
+        sys.exit(0)
     if msg == '-b64':
         msg = base64.b64decode(sys.argv[2].encode('latin1')).decode('utf-8')
     sendNotification(msg)
+    flush()